@@ -0,0 +1,139 @@
+
+# Copyright (C) 2007-2008 Mark Seaborn
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+# Micro-benchmarks for sbrowse's hot paths.
+#
+# Usage: python benchmark.py tokenizer [file...]
+#        python benchmark.py search symbol [dir]
+
+import optparse
+import re
+import sys
+import time
+
+import sbrowse
+
+
+def read_file(filename):
+    fh = open(filename, "r")
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+def time_func(func, repeat=5):
+    """Returns the best of several timings of func(), in seconds."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def tokens(line):
+    """The tokenizer that split_tokens() replaced, for comparison: yields
+    (token, is_symbol) pairs."""
+    regexp = re.compile("(.*?)([A-Za-z0-9_]+)")
+    i = 0
+    while True:
+        m = regexp.match(line, i)
+        if m:
+            yield (m.group(1), False)
+            yield (m.group(2), True)
+            i = m.end()
+        else:
+            yield (line[i:], False)
+            return
+
+
+def bench_tokenizer(filenames):
+    data = "".join(read_file(filename) for filename in filenames)
+    lines = data.splitlines(True)
+    for line in lines:
+        assert (sbrowse.split_tokens(line) ==
+                [token for token, is_symbol in tokens(line)]), line
+
+    def old_tokens():
+        for line in lines:
+            for token, is_symbol in tokens(line):
+                pass
+
+    def split_tokens():
+        for line in lines:
+            for token in sbrowse.split_tokens(line):
+                pass
+
+    def split_lines_tokens():
+        for parts in sbrowse.split_lines_tokens(data):
+            for token in parts:
+                pass
+
+    baseline = time_func(old_tokens)
+    print "%i lines, %i bytes" % (len(lines), len(data))
+    for name, func in [("tokens", old_tokens),
+                       ("split_tokens", split_tokens),
+                       ("split_lines_tokens", split_lines_tokens)]:
+        taken = time_func(func)
+        print ("%-20s %8.1f ns/line  %5.2fx"
+               % (name, taken * 1e9 / max(len(lines), 1), baseline / taken))
+
+
+def bench_search(sym, dir_path):
+    print "Searching %s for %r" % (dir_path, sym)
+    for case_sensitive in (False, True):
+        for backend in sbrowse.search_backends:
+            fileset = sbrowse.make_fileset(dir_path,
+                                           case_sensitive=case_sensitive,
+                                           search_backend=backend)
+            # Read the file list before timing, as the server would have.
+            fileset.list_files("")
+            results = []
+
+            def search():
+                results[:] = list(fileset.grep_lines("", sym))
+
+            taken = time_func(search, repeat=3)
+            print ("%-5s %-16s %8.1f ms  %i lines"
+                   % (backend,
+                      "case-sensitive" if case_sensitive else "ignoring case",
+                      taken * 1e3, len(results)))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog tokenizer [file...]\n"
+                                   "       %prog search symbol [dir]")
+    options, args = parser.parse_args(argv)
+    if len(args) == 0:
+        parser.error("Expected a benchmark name")
+    name, args = args[0], args[1:]
+    if name == "tokenizer":
+        if len(args) == 0:
+            args = [sbrowse.__file__.replace(".pyc", ".py")]
+        bench_tokenizer(args)
+    elif name == "search":
+        if len(args) not in (1, 2):
+            parser.error("Expected a symbol and optionally a directory")
+        bench_search(args[0], (args + ["."])[1])
+    else:
+        parser.error("Unknown benchmark: %r" % name)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
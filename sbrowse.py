@@ -16,27 +16,61 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA.
 
-import cStringIO as StringIO
+import Queue
+import array
+import bisect
+import cPickle as pickle
 import cgi
+import collections
 import functools
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
 import optparse
 import os
 import re
+import signal
+import stat
 import subprocess
 import sys
+import threading
+import time
+import traceback
+import wsgiref.handlers
 import wsgiref.simple_server
+import zlib
+
+try:
+    import pysvn
+except ImportError:
+    pysvn = None
 
 
 css_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                         "styles.css")
 
 
+# Name of the files that give links from the files in their directory,
+# and its subdirectories, to other sites.  Each line is "name:URL",
+# where the URL contains "%s" for the file's path relative to the
+# directory.
+crossrefs_file = "crossrefs.sbrowse"
+
+
 def not_found(start_response):
     start_response("404 Not found", [("Content-Type", "text/html")])
     return ["404 Not found"]
 
 
-def handle_request(fileset, environ, start_response):
+def bad_request(start_response, message):
+    start_response("400 Bad request", [("Content-Type", "text/html")])
+    return ["400 Bad request: %s" % cgi.escape(message)]
+
+
+def handle_request(fileset, environ, start_response, search_cache=None,
+                   file_cache=None):
     path = environ.get("PATH_INFO", "/").lstrip("/")
     url_root = environ["SCRIPT_NAME"]
     query = dict(cgi.parse_qsl(environ["QUERY_STRING"]))
@@ -44,11 +78,33 @@ def handle_request(fileset, environ, start_response):
     if path == "":
         start_response("302 OK", [("Location", "%s/file/" % url_root)])
         return ()
-    if path == "search":
+    if path == "static/styles.css":
+        return serve_stylesheet(environ, start_response)
+    if path == "find":
         start_response("200 OK", [("Content-Type", "text/html")])
+        return find_files(fileset, url_root, query.get("q", ""))
+    if path == "search":
         subdir = query.get("dir", "")
         check_filename(subdir)
-        return sym_search(fileset, url_root, subdir, query["sym"])
+        sym = query["sym"]
+        try:
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", search_results_limit))
+        except ValueError:
+            return bad_request(start_response,
+                               "offset and limit must be integers")
+        # Larger pages would defeat the bound on the cost of a search.
+        offset = max(offset, 0)
+        limit = min(max(limit, 1), search_results_limit)
+        start_response("200 OK", [("Content-Type", "text/html")])
+        fileset.note_viewed(subdir)
+        make_output = lambda discard: sym_search(
+            fileset, url_root, subdir, sym, offset, limit, on_timeout=discard)
+        if search_cache is None:
+            return make_output(None)
+        key = (url_root, subdir, sym, offset, limit,
+               fileset.revision(subdir))
+        return cached_output(search_cache, key, make_output)
     if "/" not in path:
         return not_found(start_response)
     elt, rest = path.split("/", 1)
@@ -60,14 +116,143 @@ def handle_request(fileset, environ, start_response):
             start_response("302 OK",
                            [("Location", "%s/file/%s/" % (url_root, filename))])
             return ()
-        else:
+        subdir = ""
+        if fileset.is_dir(filename):
+            fileset.note_viewed(filename.rstrip("/"))
             start_response("200 OK", [("Content-Type", "text/html")])
-            subdir = ""
-            return show_file_or_dir(fileset, url_root, filename, subdir, query)
+            return show_dir(fileset, url_root, filename, subdir)
+        fileset.note_viewed(os.path.dirname(filename))
+        return serve_file(fileset, environ, start_response, url_root,
+                          filename, subdir, query, file_cache)
     else:
         return not_found(start_response)
 
 
+def serve_file(fileset, environ, start_response, url_root, filename, subdir,
+               query, file_cache):
+    # The rendering only depends on the file's contents and the query,
+    # so the file's mtime and size stand in for its contents.
+    st = fileset.stat_path(filename)
+    try:
+        window = file_window(st.st_size, query)
+    except ValueError:
+        return bad_request(start_response, "start and count must be integers")
+    key = (url_root, filename, subdir, query.get("sym"), window,
+           st.st_mtime, st.st_size)
+    etag = '"%s"' % hashlib.sha1(repr(key)).hexdigest()
+    last_modified = wsgiref.handlers.format_date_time(st.st_mtime)
+    headers = [("ETag", etag), ("Last-Modified", last_modified)]
+    if "HTTP_IF_NONE_MATCH" in environ:
+        not_modified = etag_matches(environ, etag)
+    else:
+        not_modified = (environ.get("HTTP_IF_MODIFIED_SINCE") ==
+                        last_modified)
+    if not_modified:
+        start_response("304 Not Modified", headers)
+        return ()
+    start_response("200 OK", [("Content-Type", "text/html")] + headers)
+    make_output = lambda discard: show_file(fileset, url_root, filename,
+                                            subdir, query, window)
+    if file_cache is None:
+        return make_output(None)
+    return cached_output(file_cache, key, make_output)
+
+
+def etag_matches(environ, etag):
+    """Returns whether the request's If-None-Match header lists etag."""
+    # Ignore the weak marker that buffer_response() adds to ETags of
+    # compressed responses.
+    return etag in [strip_prefix(value.strip(), "W/") for value
+                    in environ.get("HTTP_IF_NONE_MATCH", "").split(",")]
+
+
+def strip_prefix(string, prefix):
+    if string.startswith(prefix):
+        return string[len(prefix):]
+    return string
+
+
+def buffer_response(app, chunk_size=64 * 1024, compress=True,
+                    flush_interval=0.2):
+    """Wraps a WSGI app so that its output is sent in chunks of about
+    chunk_size bytes rather than as many small strings, and is
+    gzip-compressed if the client accepts that.  Output is sent before
+    a chunk is full when the app yields a Flush, and when the app
+    produces more output after a pause of flush_interval seconds, so
+    that slow pages are still streamed.  The app must call
+    start_response before returning its output."""
+    def wrapper(environ, start_response):
+        use_gzip = [False]
+        def start(status, headers, *exc_info):
+            content_type = dict(headers).get("Content-Type", "")
+            if (compress and status.startswith("200 ") and
+                content_type.startswith("text/") and
+                "gzip" in environ.get("HTTP_ACCEPT_ENCODING", "")):
+                use_gzip[0] = True
+                # The compressed bytes differ, so the ETag can only be
+                # a weak one.
+                headers = [(key, "W/" + value if key == "ETag" else value)
+                           for key, value in headers]
+                headers += [("Content-Encoding", "gzip"),
+                            ("Vary", "Accept-Encoding")]
+            return start_response(status, headers, *exc_info)
+        iterable = app(environ, start)
+        compressor = None
+        if use_gzip[0]:
+            # wbits of 16 + MAX_WBITS gives a gzip header and trailer.
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+        return coalesce_output(iterable, chunk_size, compressor,
+                               flush_interval)
+    return wrapper
+
+
+class Flush(str):
+
+    """Output after which buffer_response() sends everything it has
+    buffered, because the app may take a while to produce more (for
+    example, while grep is running)."""
+
+
+def coalesce_output(iterable, chunk_size, compressor=None,
+                    flush_interval=None):
+    parts = []
+    # The number of bytes buffered, before compression, so that
+    # compression doesn't hold back the output for longer.
+    size = 0
+    last_sent = time.time()
+    try:
+        for chunk in iterable:
+            flush = isinstance(chunk, Flush)
+            size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            parts.append(chunk)
+            now = time.time()
+            if (size >= chunk_size or flush or
+                (flush_interval is not None and
+                 now - last_sent >= flush_interval)):
+                if compressor is not None:
+                    # Make everything so far decodable by the client.
+                    parts.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+                data = "".join(parts)
+                parts = []
+                size = 0
+                last_sent = now
+                if len(data) > 0:
+                    yield data
+        if compressor is not None:
+            parts.append(compressor.flush())
+        data = "".join(parts)
+        if len(data) > 0:
+            yield data
+    finally:
+        # Pass on the close() call that WSGI servers make when they
+        # have finished with the output.
+        if hasattr(iterable, "close"):
+            iterable.close()
+
+
 def check_filename(filename):
     if filename.startswith("/"):
         raise AssertionError("Absolute pathname: %r" % filename)
@@ -83,23 +268,618 @@ def split_path(filename):
         return filename, ""
 
 
-def stylesheet():
+def read_stylesheet():
     fh = open(css_file, "r")
     try:
-        yield "<style type='text/css'>\n"
-        yield fh.read()
-        yield "</style>\n"
+        return fh.read()
     finally:
         fh.close()
 
 
+# The stylesheet is read once, at startup, and served from memory.
+stylesheet_data = read_stylesheet()
+stylesheet_etag = '"%s"' % hashlib.sha1(stylesheet_data).hexdigest()
+# Number of seconds for which browsers may use their copy of the
+# stylesheet without checking it with us.
+stylesheet_max_age = 24 * 60 * 60
+
+
+def stylesheet(url_root):
+    yield ("<link rel='stylesheet' type='text/css' "
+           "href='%s/static/styles.css'>\n" % url_root)
+
+
+def serve_stylesheet(environ, start_response):
+    headers = [("ETag", stylesheet_etag),
+               ("Cache-Control", "public, max-age=%i" % stylesheet_max_age)]
+    if etag_matches(environ, stylesheet_etag):
+        start_response("304 Not Modified", headers)
+        return ()
+    start_response("200 OK", [("Content-Type", "text/css")] + headers)
+    return [stylesheet_data]
+
+
+# The group makes symbol_regexp.split() return the symbols too.
+symbol_regexp = re.compile("([A-Za-z0-9_]+)")
+
+
+class LRUCache(object):
+
+    """Thread-safe cache that discards the least recently used entries
+    to stay within a maximum number of entries and a maximum total size
+    in bytes.  Values are strings unless put() is given their size."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            # Move the entry to the most recently used end.
+            self._entries[key] = entry
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+        if size > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while (len(self._entries) > self.max_entries or
+                   self._size > self.max_bytes):
+                old_key, (old_value, old_size) = \
+                    self._entries.popitem(last=False)
+                self._size -= old_size
+        finally:
+            self._lock.release()
+
+
+def cached_output(cache, key, make_output):
+    """Returns the output cached under key, or else the output of
+    make_output(discard), which is added to the cache once it has all
+    been produced, unless discard() has been called to say that the
+    output should not be cached (for example, because it is
+    incomplete)."""
+    value = cache.get(key)
+    if value is not None:
+        return [value]
+    discarded = []
+    return fill_cache(cache, key,
+                      make_output(lambda: discarded.append(True)), discarded)
+
+
+def fill_cache(cache, key, iterable, discarded):
+    chunks = []
+    size = 0
+    for chunk in iterable:
+        # Stop collecting the output if it is too big to be cached.
+        if chunks is not None:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > cache.max_bytes:
+                chunks = None
+        yield chunk
+    if chunks is not None and len(discarded) == 0:
+        cache.put(key, "".join(chunks))
+
+
+# Number of bytes at the start of a file that are checked for NUL
+# characters to decide whether it is binary, as grep and Git do.
+binary_check_size = 8000
+# Files bigger than this many bytes are shown as plain text, without
+# links from their symbols.
+huge_file_size = 16 << 20
+
+
+def is_binary_data(data):
+    return "\0" in data[:binary_check_size]
+
+
+def trigrams(data):
+    return set(data[i:i + 3] for i in xrange(len(data) - 2))
+
+
+class SearchIndex(object):
+
+    """Trigram index of the contents of a set of files.
+
+    Any file that contains a string must contain every three-character
+    substring of that string, so intersecting the files listed for each
+    of a symbol's trigrams gives a small superset of the files that
+    grep would report.  Trigrams are lowercased so that the index can
+    serve both case-sensitive and case-insensitive searches.
+
+    The index also records, for each symbol, the lines of each file on
+    which it occurs, so that symbol searches can be answered without
+    reading every file that grep would return.
+
+    Each file is recorded with a "stamp" (e.g. its mtime and size) so
+    that the index can be updated by re-reading only the files whose
+    stamp has changed.
+    """
+
+    version = 5
+
+    # The attributes that are written to disk.  The others are derived
+    # from them or describe the copy on disk.
+    saved_attrs = ("_paths", "_files", "_postings", "_symbols")
+
+    # Maximum number of changes to keep for appending to the log.  The
+    # whole index is written out instead after more changes than this.
+    max_unsaved = 10000
+
+    def __init__(self):
+        # Maps file ID -> path.  Entries are set to None when a file
+        # is removed; compact() reclaims them.
+        self._paths = []
+        # Maps path -> (file ID, stamp) for the live files.
+        self._files = {}
+        # Maps trigram -> list of file IDs, in increasing order.
+        self._postings = {}
+        # Maps symbol -> list of (file ID, line numbers) pairs.  A line
+        # number is repeated if the symbol occurs on it more than once.
+        self._symbols = {}
+        # Sorted list of (symbol, lowercased symbol) for the keys of
+        # _symbols, or None if out of date.
+        self._vocabulary = None
+        # Log records for the changes made since the index was loaded
+        # or saved, or None if the whole index must be written out.
+        self._unsaved = None
+        # Identifies the copy of the index on disk, so that a log
+        # written for an older copy is not applied to a newer one.
+        self._snapshot_id = None
+        # Sizes in bytes of the index file and of its log.
+        self._snapshot_size = 0
+        self._log_size = 0
+
+    def stamps(self):
+        return dict((path, stamp)
+                    for path, (file_id, stamp) in self._files.iteritems())
+
+    def add_file(self, path, stamp, data):
+        if is_binary_data(data):
+            # Binary files are recorded, so that they are not reread
+            # until they change, but their contents are not indexed.
+            data = ""
+        grams = trigrams(data.lower())
+        line_nos = {}
+        for line_no, line in enumerate(data.split("\n")):
+            for symbol in symbol_regexp.findall(line):
+                line_nos.setdefault(symbol, []).append(line_no)
+        self._log(("add", path, stamp, grams, line_nos))
+        self._add_file(path, stamp, grams, line_nos)
+
+    def _add_file(self, path, stamp, grams, line_nos):
+        if path in self._files:
+            self._remove_file(path)
+        file_id = len(self._paths)
+        self._paths.append(path)
+        self._files[path] = (file_id, stamp)
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(file_id)
+        for symbol, lines in line_nos.iteritems():
+            if symbol not in self._symbols:
+                self._symbols[symbol] = []
+                self._vocabulary = None
+            self._symbols[symbol].append((file_id, lines))
+
+    def _log(self, record):
+        if self._unsaved is not None:
+            self._unsaved.append(record)
+            if len(self._unsaved) > self.max_unsaved:
+                self._unsaved = None
+
+    def _apply(self, record):
+        if record[0] == "add":
+            self._add_file(*record[1:])
+        elif record[1] in self._files:
+            # Another process may have logged the same removal.
+            self._remove_file(record[1])
+
+    def remove_file(self, path):
+        self._log(("remove", path))
+        self._remove_file(path)
+
+    def _remove_file(self, path):
+        # Removing the file ID from the posting lists would mean
+        # scanning all of them, so we leave it there and filter it out
+        # in candidates().
+        file_id, stamp = self._files.pop(path)
+        self._paths[file_id] = None
+        if len(self._paths) > 2 * len(self._files) + 100:
+            self.compact()
+
+    def compact(self):
+        new_ids = {}
+        paths = []
+        for file_id, path in enumerate(self._paths):
+            if path is not None:
+                new_ids[file_id] = len(paths)
+                paths.append(path)
+        postings = {}
+        for gram, file_ids in self._postings.iteritems():
+            file_ids = [new_ids[file_id] for file_id in file_ids
+                        if file_id in new_ids]
+            if len(file_ids) > 0:
+                postings[gram] = file_ids
+        symbols = {}
+        for symbol, occurrences in self._symbols.iteritems():
+            occurrences = [(new_ids[file_id], line_nos)
+                           for file_id, line_nos in occurrences
+                           if file_id in new_ids]
+            if len(occurrences) > 0:
+                symbols[symbol] = occurrences
+        self._paths = paths
+        self._symbols = symbols
+        self._vocabulary = None
+        self._files = dict((path, (new_ids[file_id], stamp))
+                           for path, (file_id, stamp)
+                           in self._files.iteritems())
+        self._postings = postings
+
+    def candidates(self, sym):
+        """Returns the sorted paths of the files that might contain sym,
+        which must be at least 3 characters long."""
+        grams = sorted(trigrams(sym.lower()),
+                       key=lambda gram: len(self._postings.get(gram, ())))
+        file_ids = set(self._postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if len(file_ids) == 0:
+                break
+            file_ids.intersection_update(self._postings.get(gram, ()))
+        paths = [self._paths[file_id] for file_id in file_ids]
+        return sorted(path for path in paths if path is not None)
+
+    def _occurrences(self, symbol, prefix):
+        for file_id, line_nos in self._symbols.get(symbol, ()):
+            path = self._paths[file_id]
+            if path is not None and path.startswith(prefix):
+                yield path, line_nos
+
+    def symbol_lines(self, sym, prefix):
+        """Returns a sorted list of (path, line numbers) pairs for the
+        files under prefix that contain sym as a whole symbol."""
+        return sorted((path, sorted(set(line_nos)))
+                      for path, line_nos in self._occurrences(sym, prefix))
+
+    def related_symbols(self, sym, prefix):
+        """Returns two dicts mapping symbols that contain sym to their
+        number of occurrences under prefix: the first for those that
+        contain it case-sensitively and the second for those that only
+        contain it when case is ignored."""
+        if self._vocabulary is None:
+            self._vocabulary = [(symbol, symbol.lower())
+                                for symbol in sorted(self._symbols)]
+        sym_lower = sym.lower()
+        syms_found = {}
+        syms_found_ci = {}
+        for symbol, symbol_lower in self._vocabulary:
+            if symbol == sym:
+                continue
+            if sym in symbol:
+                counts = syms_found
+            elif sym_lower in symbol_lower:
+                counts = syms_found_ci
+            else:
+                continue
+            count = sum(len(line_nos) for path, line_nos
+                        in self._occurrences(symbol, prefix))
+            if count > 0:
+                counts[symbol] = count
+        return syms_found, syms_found_ci
+
+    def save(self, filename):
+        """Writes the index to the file.  If it was loaded from or saved
+        to the file before, only the changes since then are written, by
+        appending them to a log kept alongside the file, until the log
+        grows to half the size of the index."""
+        if (self._unsaved is not None and
+            self._log_size < self._snapshot_size / 2):
+            self._append_log(filename + ".log")
+        else:
+            self._write_snapshot(filename)
+        self._unsaved = []
+
+    def _write_snapshot(self, filename):
+        self._snapshot_id = os.urandom(16).encode("hex")
+        state = dict((attr, getattr(self, attr)) for attr in self.saved_attrs)
+        # Write to a temporary file and rename it so that a concurrent
+        # reader never sees a partially-written index.
+        temp_filename = "%s.tmp%i" % (filename, os.getpid())
+        fh = open(temp_filename, "wb")
+        try:
+            pickle.dump((self.version, self._snapshot_id, state), fh,
+                        pickle.HIGHEST_PROTOCOL)
+            self._snapshot_size = fh.tell()
+        finally:
+            fh.close()
+        os.rename(temp_filename, filename)
+        # The log applies to the old index.  A reader that has already
+        # loaded the new index ignores it, because the IDs don't match.
+        try:
+            os.unlink(filename + ".log")
+        except OSError:
+            pass
+        self._log_size = 0
+
+    def _append_log(self, log_filename):
+        fh = open(log_filename, "ab")
+        try:
+            fh.seek(0, os.SEEK_END)
+            records = self._unsaved
+            if fh.tell() == 0:
+                records = [self._snapshot_id] + records
+            # One write, so that the records from processes that share
+            # the index are not interleaved.
+            fh.write("".join(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+                             for record in records))
+            self._log_size = fh.tell()
+        finally:
+            fh.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Returns None if the file was written by an incompatible
+        version of the index."""
+        fh = open(filename, "rb")
+        try:
+            saved = pickle.load(fh)
+            size = fh.tell()
+        finally:
+            fh.close()
+        if saved[0] != cls.version:
+            return None
+        version, snapshot_id, state = saved
+        index = cls()
+        index.__dict__.update(state)
+        index._snapshot_id = snapshot_id
+        index._snapshot_size = size
+        index._read_log(filename + ".log")
+        index._unsaved = []
+        return index
+
+    def _read_log(self, log_filename):
+        try:
+            fh = open(log_filename, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                if pickle.load(fh) != self._snapshot_id:
+                    return
+                while True:
+                    self._log_size = fh.tell()
+                    self._apply(pickle.load(fh))
+            except (EOFError, pickle.UnpicklingError):
+                # The end of the log, or a record that is still being
+                # appended.
+                pass
+        finally:
+            fh.close()
+
+
+def fuzzy_score(query, path):
+    """Scores a match of query's characters, in order, in path.  Both
+    should be lowercase.  Returns None if there is no match, otherwise
+    (score, positions of the matched characters).  The characters are
+    matched from the end, so that matches in the basename are found in
+    preference to matches in the directory names."""
+    positions = []
+    i = len(path)
+    for char in reversed(query):
+        i = path.rfind(char, 0, i)
+        if i < 0:
+            return None
+        positions.append(i)
+    positions.reverse()
+    basename_start = path.rfind("/") + 1
+    score = 0
+    prev = None
+    for pos in positions:
+        score += 1
+        if pos >= basename_start:
+            score += 2
+        if pos == 0 or path[pos - 1] in "/_-. ":
+            score += 3
+        if prev is not None and pos == prev + 1:
+            score += 4
+        prev = pos
+    return score, positions
+
+
+class PathIndex(object):
+
+    """Index for fuzzy matching of paths.  The lowercased paths are
+    joined into one string, shortest first, so that regexp searches
+    can pick out the paths that match the query; only those are then
+    scored in Python.
+
+    Matches are ranked first by how well the basename matches: the
+    paths whose basename contains the query come first, then those
+    whose basename contains the query's characters in order, then the
+    rest.  Within each of these tiers, paths are ranked by
+    fuzzy_score(), then shorter paths first.  Only the first
+    max_scored matches in a tier are scored, so for very common
+    queries the best match may be missed if it is not among the
+    shortest paths in its tier."""
+
+    # Maximum number of matches scored for each tier.
+    max_scored = 2000
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._sorted = sorted(paths, key=len)
+        self._text = "\n".join(self._sorted).lower()
+        # The offset of each path in _text, followed by a sentinel.
+        self._starts = array.array("L")
+        pos = 0
+        for path in self._sorted:
+            self._starts.append(pos)
+            pos += len(path) + 1
+        self._starts.append(pos)
+
+    def _tier_regexps(self, query):
+        # Each character of the query is followed by a class that
+        # matches up to the next character, but not past it, so that
+        # the regexp can only match the first occurrence of each
+        # character.  This means a failed match is not retried by
+        # backtracking over different choices of characters.
+        chars = [re.escape(char) for char in query]
+        subsequence = "".join("%s[^%s\n]*" % (char, next_char)
+                              for char, next_char in zip(chars, chars[1:]))
+        subsequence += chars[-1]
+        regexps = []
+        if "/" not in query:
+            # In the basename: the match is not followed by a "/".
+            regexps.append("%s[^/\n]*$" % "".join(chars))
+            regexps.append("".join("%s[^%s/\n]*" % (char, next_char)
+                                   for char, next_char
+                                   in zip(chars, chars[1:])) +
+                           chars[-1] + "[^/\n]*$")
+        regexps.append(subsequence)
+        return [re.compile(regexp, re.MULTILINE) for regexp in regexps]
+
+    def find(self, query, limit):
+        """Returns up to limit (path, positions of matched characters)
+        pairs for the paths that best match query."""
+        query = query.lower()
+        if query == "" or "\n" in query:
+            return []
+        regexps = self._tier_regexps(query)
+        # Every match is a match for the last, loosest tier, so no tier
+        # has a match before the first of those.
+        first = regexps[-1].search(self._text)
+        if first is None:
+            return []
+        first_start = self._starts[
+            bisect.bisect_right(self._starts, first.start()) - 1]
+        results = []
+        seen = set()
+        for tier, regexp in enumerate(regexps):
+            scored = 0
+            pos = first_start
+            while scored < self.max_scored:
+                match = regexp.search(self._text, pos)
+                if match is None:
+                    break
+                path_no = bisect.bisect_right(self._starts, match.start()) - 1
+                # Carry on from the start of the next path.
+                pos = self._starts[path_no + 1]
+                if path_no in seen:
+                    continue
+                seen.add(path_no)
+                scored += 1
+                path = self._sorted[path_no]
+                score, positions = fuzzy_score(
+                    query, self._text[self._starts[path_no]:pos - 1])
+                results.append(((tier, -score, len(path), path),
+                                path, positions))
+            # Matches in later tiers rank below all of these, and if
+            # this tier had too many matches to score, the later tiers'
+            # matches include the rest of them, unscored.
+            if len(results) >= limit or scored == self.max_scored:
+                break
+        best = heapq.nsmallest(limit, results)
+        return [(path, positions) for rank, path, positions in best]
+
+
+def index_prefix(subdir):
+    if subdir == "":
+        return ""
+    return subdir.rstrip("/") + "/"
+
+
+search_backends = ("grep", "mmap")
+
+
+def whole_word_regexp(sym):
+    """Matches sym, case-sensitively, where it is neither preceded nor
+    followed by a character that can be part of a symbol.  This is what
+    "grep -w" matches."""
+    return re.compile("(?<![A-Za-z0-9_])%s(?![A-Za-z0-9_])" % re.escape(sym))
+
+
+def line_regexp(sym, whole_word):
+    if whole_word:
+        return whole_word_regexp(sym)
+    return re.compile(re.escape(sym), re.IGNORECASE)
+
+
+def default_search_processes():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 class FileSetBase(object):
 
-    def __init__(self, dir_path, case_sensitive=False):
+    def __init__(self, dir_path, case_sensitive=False, index_dir=None,
+                 search_timeout=None, search_backend="grep",
+                 search_processes=None):
         self._dir_path = dir_path
         # Setting case_sensitive to True is an optimisation, because
         # "grep -i" is significantly slower than case-sensitive grep.
         self._case_sensitive = case_sensitive
+        # Number of seconds after which a grep is abandoned, or None.
+        self._search_timeout = search_timeout
+        # "grep" runs grep (or "git grep") in a subprocess; "mmap"
+        # searches the files in-process, using the cached file list.
+        assert search_backend in search_backends, search_backend
+        self._search_backend = search_backend
+        # Number of grep processes to run at the same time for one search.
+        if search_processes is None:
+            search_processes = default_search_processes()
+        self._search_processes = search_processes
+        # If index_dir is given, grep_files uses a SearchIndex that is
+        # stored in that directory rather than running grep over the
+        # whole tree for each search.
+        self._index_dir = index_dir
+        self._index = None
+        self._index_checked = None
+        # Protects the index when requests are served by several threads.
+        self._index_lock = threading.Lock()
+        self._dir_cache = LRUCache(max_entries=1000, max_bytes=16 << 20)
+        self._line_offsets_cache = LRUCache(max_entries=100,
+                                            max_bytes=64 << 20)
+        self._file_kinds = LRUCache(max_entries=10000, max_bytes=4 << 20)
+        # Maps directories to (directory's mtime, crossrefs file's mtime
+        # or None if there is none, links).
+        self._crossrefs = LRUCache(max_entries=10000, max_bytes=4 << 20)
+        # (sorted paths, state for _file_list_changed()), or None.
+        self._file_list = None
+        self._path_index = None
+        self._file_list_checked = None
+        self._file_list_lock = threading.Lock()
+        # Incremented whenever the file list is reread or the index is
+        # changed, for revision().
+        self._file_list_version = 0
+        self._index_version = 0
+        # The thread started by start_indexer(), or None.
+        self._indexer = None
+        self._indexer_stopped = threading.Event()
+        # Set once the background indexer has brought the index up to
+        # date for the first time.
+        self._index_ready = False
+        # Maps recently viewed directories to the time they were viewed,
+        # so that the background indexer can update them first.
+        self._viewed = {}
+        self._viewed_version = 0
+        self._viewed_lock = threading.Lock()
 
     def _get_path(self, filename):
         check_filename(filename)
@@ -114,58 +894,853 @@ class FileSetBase(object):
     def stat_path(self, filename):
         return os.stat(self._get_path(filename))
 
+    # Minimum number of seconds between checks for added or removed
+    # files.
+    file_list_check_interval = 1
+
+    def _get_file_list(self):
+        self._file_list_lock.acquire()
+        try:
+            now = time.time()
+            if (self._file_list is None or
+                now - self._file_list_checked >=
+                self.file_list_check_interval):
+                if (self._file_list is None or
+                    self._file_list_changed(self._file_list[1])):
+                    paths, state = self._read_file_list()
+                    paths.sort()
+                    self._file_list = (paths, state)
+                    self._file_list_version += 1
+                # Only a real check restarts the interval, so that the
+                # list is checked even if it is asked for more often.
+                self._file_list_checked = now
+            return self._file_list[0]
+        finally:
+            self._file_list_lock.release()
+
+    def list_files(self, subdir):
+        """Returns the sorted paths, relative to subdir, of the files
+        (and for some FileSets, directories) under subdir.  The list for
+        the whole tree is kept in memory and reread when it changes."""
+        paths = self._get_file_list()
+        prefix = index_prefix(subdir)
+        if prefix == "":
+            return paths
+        # The paths starting with "dir/" sort between "dir/" and "dir0",
+        # since "0" follows "/" in ASCII.
+        start = bisect.bisect_left(paths, prefix)
+        end = bisect.bisect_left(paths, prefix[:-1] + "0", start)
+        return [path[len(prefix):] for path in paths[start:end]]
+
+    def get_path_index(self):
+        """Returns a PathIndex of list_files(""), rebuilt whenever the
+        file list is reread."""
+        paths = self.list_files("")
+        path_index = self._path_index
+        if path_index is None or path_index.paths is not paths:
+            path_index = PathIndex(paths)
+            self._path_index = path_index
+        return path_index
+
+    def file_kind(self, filename):
+        """Returns "binary" if the file has a NUL in its first block,
+        otherwise "huge" if it is bigger than huge_file_size, otherwise
+        "text".  The result is kept until the file's inode, mtime or
+        size changes."""
+        st = self.stat_path(filename)
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        cached = self._file_kinds.get(filename)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        fh = self.open_file(filename)
+        try:
+            block = fh.read(binary_check_size)
+        finally:
+            fh.close()
+        if is_binary_data(block):
+            kind = "binary"
+        elif st.st_size > huge_file_size:
+            kind = "huge"
+        else:
+            kind = "text"
+        self._file_kinds.put(filename, (stamp, kind), len(filename) + 64)
+        return kind
+
+    def get_line_offsets(self, filename):
+        """Returns the line_offsets() of the file.  They are kept until
+        the file's mtime or size changes."""
+        st = self.stat_path(filename)
+        stamp = (st.st_mtime, st.st_size)
+        cached = self._line_offsets_cache.get(filename)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        fh = self.open_file(filename)
+        try:
+            offsets = line_offsets(fh)
+        finally:
+            fh.close()
+        self._line_offsets_cache.put(filename, (stamp, offsets),
+                                     offsets.itemsize * len(offsets))
+        return offsets
+
+    def get_file_links(self, filename):
+        """Returns a list of (name, URL) pairs for the links given by the
+        crossrefs.sbrowse files in filename's directory and its parent
+        directories.  The files need not be in the VCS's file list."""
+        links = []
+        for part1, part2 in path_splits(filename):
+            for name, url_pattern in self._read_crossrefs(part1):
+                links.append((name, url_pattern % part2))
+        return links
+
+    def _read_crossrefs(self, dir_path):
+        # Adding or removing the crossrefs file changes the directory's
+        # mtime, so a directory without one is only statted until then.
+        # The parsed file is kept until its own mtime changes.
+        try:
+            dir_mtime = self.stat_path(dir_path).st_mtime
+        except OSError:
+            return []
+        cached = self._crossrefs.get(dir_path)
+        if (cached is not None and cached[0] == dir_mtime and
+            cached[1] is None):
+            return []
+        link_file = self._get_path(os.path.join(dir_path, crossrefs_file))
+        try:
+            mtime = os.stat(link_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is None:
+            links = []
+        elif cached is not None and cached[1] == mtime:
+            links = cached[2]
+        else:
+            links = []
+            fh = open(link_file, "r")
+            try:
+                for line in fh:
+                    name, url_pattern = line.split(":", 1)
+                    links.append((name, url_pattern))
+            finally:
+                fh.close()
+        size = len(dir_path) + sum(len(name) + len(url_pattern) + 64
+                                   for name, url_pattern in links)
+        self._crossrefs.put(dir_path, (dir_mtime, mtime, links), size)
+        return links
+
+    # Maximum age in seconds of a cached directory listing.  Changing a
+    # file's size doesn't change its directory's mtime, so without this
+    # the listed sizes could be stale indefinitely.
+    dir_cache_max_age = 5
+
+    def list_dir_entries(self, filename):
+        """Returns a sorted list of (leafname, is_dir, size) for the
+        entries in the directory, with one stat() per entry.  size is
+        None for directories and for entries that can't be stat'd.
+        The listing is cached until the directory's mtime changes."""
+        dir_path = self._get_path(filename)
+        mtime = os.stat(dir_path).st_mtime
+        now = time.time()
+        cached = self._dir_cache.get(filename)
+        if cached is not None:
+            cached_mtime, cached_time, entries = cached
+            if (cached_mtime == mtime and
+                now - cached_time < self.dir_cache_max_age):
+                return entries
+        entries = []
+        for leafname in sorted(os.listdir(dir_path)):
+            try:
+                st = os.stat(os.path.join(dir_path, leafname))
+            except OSError:
+                # For example, a dangling symlink.
+                entries.append((leafname, False, None))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                entries.append((leafname, True, None))
+            else:
+                entries.append((leafname, False, st.st_size))
+        size = sum(len(leafname) + 64 for leafname, is_dir, size in entries)
+        self._dir_cache.put(filename, (mtime, now, entries), size)
+        return entries
+
     def open_file(self, filename):
         return open(self._get_path(filename), "r")
 
+    def revision(self, subdir):
+        """Returns a value that changes whenever files under subdir are
+        added, removed or modified, or when the file list or the index
+        that searches read from is updated.  Those are only refreshed
+        every file_list_check_interval and index_refresh_interval
+        seconds, so they are first refreshed here as a search would
+        refresh them: a page is then cached under the version of the
+        data that it was made from, rather than under a newer revision
+        of the tree."""
+        self._get_file_list()
+        if self._indexer is None and self._index_dir is not None:
+            self._index_lock.acquire()
+            try:
+                self._get_index()
+            finally:
+                self._index_lock.release()
+        return (self._file_list_version, self._index_version,
+                self._tree_revision(subdir))
+
+    def _tree_revision(self, subdir):
+        # Here, the latest mtime.
+        latest = 0
+        for dir_path, dirnames, leafnames in os.walk(self._get_path(subdir)):
+            paths = [dir_path] + [os.path.join(dir_path, leafname)
+                                  for leafname in leafnames]
+            for path in paths:
+                try:
+                    latest = max(latest, os.lstat(path).st_mtime)
+                except OSError:
+                    pass
+        return latest
+
+    def _read_file(self, filename):
+        fh = self.open_file(filename)
+        try:
+            return fh.read()
+        finally:
+            fh.close()
 
-def popen_filenames(args, **kwargs):
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=1024,
-                            **kwargs)
-    for line in proc.stdout:
-        yield line.rstrip("\n")
+    def _is_indexable(self, filename):
+        return True
+
+    def _index_file(self):
+        root = os.path.abspath(self._dir_path)
+        return os.path.join(self._index_dir,
+                            "%s.idx" % hashlib.sha1(root).hexdigest())
+
+    def _index_stamps(self):
+        """Returns a dict mapping each file to be indexed to a value that
+        changes whenever the file's contents change."""
+        stamps = {}
+        for filename in self.list_files(""):
+            if self._is_indexable(filename):
+                try:
+                    st = self.stat_path(filename)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    stamps[filename] = (st.st_mtime, st.st_size)
+        return stamps
+
+    def _update_index(self, index, in_background=False):
+        """Brings the index up to date, re-reading only the files that
+        have been added or changed.  Returns whether anything changed.
+        The caller must hold _index_lock, unless in_background is true:
+        then we are on the indexer thread, which is the only thread that
+        changes the index, so reading it is safe, and the index is only
+        locked while each file is changed.  In the background the files
+        are taken in order of _index_priority, and we stop early if the
+        indexer is stopped."""
+        old_stamps = index.stamps()
+        new_stamps = self._index_stamps()
+        work = [(filename, None) for filename in old_stamps
+                if filename not in new_stamps]
+        work.extend((filename, stamp)
+                    for filename, stamp in new_stamps.iteritems()
+                    if old_stamps.get(filename) != stamp)
+        # The priorities are filled in below, in the background.
+        work = [(0, filename, stamp) for filename, stamp in work]
+        heapq.heapify(work)
+        viewed_version = None
+        changed = False
+        while len(work) > 0:
+            if in_background:
+                if self._indexer_stopped.isSet():
+                    break
+                if self._viewed_version != viewed_version:
+                    # Re-prioritise the remaining files when a directory
+                    # is viewed while we are working.
+                    viewed_version, viewed = self._get_viewed()
+                    work = [(self._index_priority(filename, viewed),
+                             filename, stamp)
+                            for priority, filename, stamp in work]
+                    heapq.heapify(work)
+            priority, filename, stamp = heapq.heappop(work)
+            data = None
+            if stamp is not None:
+                try:
+                    data = self._read_file(filename)
+                except (IOError, OSError):
+                    continue
+            if in_background:
+                self._index_lock.acquire()
+            try:
+                if data is None:
+                    index.remove_file(filename)
+                else:
+                    index.add_file(filename, stamp, data)
+                self._index_version += 1
+            finally:
+                if in_background:
+                    self._index_lock.release()
+            changed = True
+        return changed
+
+    def _load_index(self):
+        index_file = self._index_file()
+        if os.path.exists(index_file):
+            self._index = SearchIndex.load(index_file)
+        if self._index is None:
+            self._index = SearchIndex()
+
+    def _save_index(self):
+        if not os.path.exists(self._index_dir):
+            os.makedirs(self._index_dir)
+        self._index.save(self._index_file())
+
+    # Minimum number of seconds between checks for changed files.
+    index_refresh_interval = 2
+
+    def _get_index(self):
+        if self._index_dir is None:
+            return None
+        if self._index is None:
+            self._load_index()
+        now = time.time()
+        if (self._index_checked is None or
+            now - self._index_checked >= self.index_refresh_interval):
+            if self._update_index(self._index):
+                self._save_index()
+            self._index_checked = now
+        return self._index
+
+    def start_indexer(self):
+        """Starts a thread that keeps the index and the file list up to
+        date in the background, polling for changes, so that requests
+        don't have to wait for indexing."""
+        assert self._index_dir is not None
+        self._indexer = threading.Thread(target=self._run_indexer)
+        self._indexer.setDaemon(True)
+        self._indexer.start()
+
+    def stop_indexer(self):
+        """Stops the thread started by start_indexer() and waits for it
+        to finish what it is doing."""
+        self._indexer_stopped.set()
+        self._indexer.join()
+
+    # Number of recently viewed directories that the background indexer
+    # gives priority to.
+    max_viewed_dirs = 100
+
+    def note_viewed(self, dir_path):
+        """Records that the directory was just viewed or searched."""
+        if self._indexer is None or dir_path == "":
+            return
+        self._viewed_lock.acquire()
+        try:
+            self._viewed[dir_path] = time.time()
+            if len(self._viewed) > self.max_viewed_dirs:
+                del self._viewed[min(self._viewed, key=self._viewed.get)]
+            self._viewed_version += 1
+        finally:
+            self._viewed_lock.release()
+
+    def _get_viewed(self):
+        self._viewed_lock.acquire()
+        try:
+            return self._viewed_version, dict(self._viewed)
+        finally:
+            self._viewed_lock.release()
+
+    def _index_priority(self, filename, viewed):
+        # Files under the most recently viewed directories come first.
+        latest = 0
+        dir_path = os.path.dirname(filename)
+        while dir_path != "":
+            latest = max(latest, viewed.get(dir_path, 0))
+            dir_path = os.path.dirname(dir_path)
+        return -latest
+
+    def _run_indexer(self):
+        self._load_index()
+        while not self._indexer_stopped.isSet():
+            try:
+                # Rereads the file list if it has changed, so that
+                # requests don't have to.
+                self.get_path_index()
+                if self._update_index(self._index, in_background=True):
+                    # Queries can change the index (see related_symbols),
+                    # so it must not be written out at the same time.
+                    self._index_lock.acquire()
+                    try:
+                        self._save_index()
+                    finally:
+                        self._index_lock.release()
+                self._index_ready = True
+            except Exception:
+                traceback.print_exc()
+            self._indexer_stopped.wait(self.index_refresh_interval)
+
+    def _query_index(self, method, *args):
+        """Calls the given method of the index with the index locked.
+        Returns None if there is no index."""
+        if self._indexer is not None:
+            # Never wait for the background indexer: callers fall back
+            # to grep until the index is ready, and while it is busy.
+            if not self._index_ready or not self._index_lock.acquire(False):
+                return None
+            try:
+                return getattr(self._index, method)(*args)
+            finally:
+                self._index_lock.release()
+        self._index_lock.acquire()
+        try:
+            index = self._get_index()
+            if index is None:
+                return None
+            return getattr(index, method)(*args)
+        finally:
+            self._index_lock.release()
+
+    def _index_candidates(self, sym):
+        # Symbols shorter than a trigram can't be looked up in the index.
+        if len(sym) >= 3:
+            return self._query_index("candidates", sym)
+        return None
+
+    def grep_files(self, subdir, sym, whole_word=False):
+        """Yields the files under subdir that contain sym.  If whole_word
+        is true, only files that contain sym as a whole symbol, with the
+        same case, are reported, which are the only files that can have
+        lines that SymSearch matches."""
+        candidates = self._index_candidates(sym)
+        if candidates is not None:
+            return self._grep_candidates(candidates, subdir, sym, whole_word)
+        if self._search_backend == "mmap":
+            return (rel_path for rel_path, buf
+                    in self._mmap_grep(subdir, sym, whole_word))
+        return self._grep_files(subdir, sym, whole_word)
+
+    def grep_lines(self, subdir, sym, whole_word=False, all_lines=False):
+        """Yields (filename, line number, line) for each line that
+        contains sym, ignoring case (or as a whole symbol if whole_word
+        is true), in the files that grep_files reports.  If all_lines is
+        true, the lines containing sym ignoring case are yielded even
+        if whole_word is true.  The line has its line ending removed."""
+        line_whole_word = whole_word and not all_lines
+        candidates = self._index_candidates(sym)
+        if candidates is not None:
+            filenames = self._grep_candidates(candidates, subdir, sym,
+                                              whole_word)
+        elif self._search_backend == "mmap":
+            return self._mmap_grep_lines(subdir, sym, whole_word,
+                                         line_whole_word)
+        else:
+            filenames = self._grep_files(subdir, sym, whole_word)
+        return self._grep_lines_of_files(subdir, sym, line_whole_word,
+                                         filenames)
+
+    # Number of files that each grep process is given to search.
+    grep_shard_size = 500
+
+    def _grep_files(self, subdir, sym, whole_word):
+        # The cached file list is split into shards that are searched by
+        # several grep processes at once, so that searching a big tree
+        # without an index scales with the number of cores.  grep -l
+        # reports files in the order it is given them, and the shards'
+        # results are yielded in order, so the output is sorted.
+        prefix = index_prefix(subdir)
+        paths = [rel_path for rel_path in self.list_files(subdir)
+                 if self._is_indexable(prefix + rel_path)]
+        deadline = None
+        if self._search_timeout is not None:
+            deadline = time.time() + self._search_timeout
+        size = self.grep_shard_size
+        return parallel_chain(
+            [functools.partial(self._grep_shard, subdir, sym, whole_word,
+                               paths[i:i + size], deadline)
+             for i in xrange(0, len(paths), size)],
+            self._search_processes)
+
+    def _grep_shard(self, subdir, sym, whole_word, paths, deadline):
+        timeout = None
+        if deadline is not None:
+            # Shards that start late get what is left of the timeout.
+            timeout = max(deadline - time.time(), 0)
+        # "-s" hides errors about files removed since the list was read,
+        # and "-I" skips binary files.  In the C locale, grep only treats
+        # files containing NULs as binary, rather than also those that
+        # aren't valid in the locale's encoding, and "-i" is faster.
+        return popen_filenames(
+            ["grep", "-l", "-s", "-I", "--directories=skip"] +
+            self._grep_mode_args(whole_word) +
+            ["-e", sym, "--"] + paths,
+            cwd=self._get_path(subdir), timeout=timeout,
+            env=dict(os.environ, LC_ALL="C"))
+
+    def _grep_mode_args(self, whole_word):
+        if whole_word:
+            return ["-w"]
+        # Note that using "-i" makes grep go a lot slower.
+        return [] if self._case_sensitive else ["-i"]
+
+    def _grep_lines_of_files(self, subdir, sym, whole_word, filenames):
+        regexp = line_regexp(sym, whole_word)
+        try:
+            for rel_filename in filenames:
+                fh = self.open_file(os.path.join(subdir, rel_filename))
+                try:
+                    for line_no, line in enumerate(fh):
+                        if regexp.search(line):
+                            yield rel_filename, line_no, line.rstrip("\n\r")
+                finally:
+                    fh.close()
+        finally:
+            if hasattr(filenames, "close"):
+                filenames.close()
+
+    def _mmap_files(self, subdir):
+        """Yields (filename, buffer) for each non-empty regular file under
+        subdir that grep would search.  The buffer is an mmap of the file
+        that is only valid until the next item is requested."""
+        prefix = index_prefix(subdir)
+        for rel_path in self.list_files(subdir):
+            filename = prefix + rel_path
+            if not self._is_indexable(filename):
+                continue
+            path = self._get_path(filename)
+            try:
+                st = os.stat(path)
+                if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+                    continue
+                fh = open(path, "rb")
+            except (IOError, OSError):
+                continue
+            try:
+                try:
+                    buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    # The file was truncated since we stat'd it.
+                    continue
+                try:
+                    yield rel_path, buf
+                finally:
+                    buf.close()
+            finally:
+                fh.close()
+
+    def _mmap_grep(self, subdir, sym, whole_word):
+        """Yields (filename, buffer) for the files under subdir that
+        contain sym, as grep_files would but without starting any
+        processes."""
+        if whole_word:
+            # Only run the regexp on files that contain sym at all.
+            regexp = whole_word_regexp(sym)
+            contains = lambda buf: (buf.find(sym) != -1 and
+                                    regexp.search(buf) is not None)
+        elif self._case_sensitive:
+            contains = lambda buf: buf.find(sym) != -1
+        else:
+            # Lowercasing a copy is several times faster than searching
+            # the buffer with an IGNORECASE regexp.
+            sym_lower = sym.lower()
+            contains = lambda buf: sym_lower in buf[:].lower()
+        for rel_path, buf in self._mmap_files(subdir):
+            if (buf.find("\0", 0, binary_check_size) == -1 and
+                contains(buf)):
+                yield rel_path, buf
+
+    def _mmap_grep_lines(self, subdir, sym, whole_word, line_whole_word):
+        # Rather than splitting the whole file into lines, find the
+        # matches and extract only the lines around them, counting the
+        # newlines in between to get the line numbers.
+        if line_whole_word:
+            regexp = whole_word_regexp(sym)
+        else:
+            # Case-insensitive matches are found in a lowercased copy of
+            # the file, which has the same offsets.
+            regexp = re.compile(re.escape(sym.lower()))
+        for rel_path, buf in self._mmap_grep(subdir, sym, whole_word):
+            data = buf[:]
+            haystack = data if line_whole_word else data.lower()
+            line_no = 0
+            pos = 0
+            while True:
+                match = regexp.search(haystack, pos)
+                if match is None:
+                    break
+                start = match.start()
+                line_no += data.count("\n", pos, start)
+                line_start = data.rfind("\n", 0, start) + 1
+                line_end = data.find("\n", start)
+                if line_end == -1:
+                    line_end = len(data)
+                yield rel_path, line_no, data[line_start:line_end].rstrip("\r")
+                line_no += 1
+                pos = line_end + 1
+
+    def symbol_matches(self, subdir, sym):
+        """Returns None if there is no index, otherwise a sorted list of
+        (filename, line numbers) pairs for the files under subdir that
+        contain sym as a whole symbol."""
+        prefix = index_prefix(subdir)
+        matches = self._query_index("symbol_lines", sym, prefix)
+        if matches is None:
+            return None
+        return [(filename[len(prefix):], line_nos)
+                for filename, line_nos in matches]
+
+    def related_symbols(self, subdir, sym):
+        """Returns None if there is no index, otherwise the dicts
+        (syms_found, syms_found_ci) as collected by SymSearch."""
+        return self._query_index("related_symbols", sym, index_prefix(subdir))
+
+    def _grep_candidates(self, candidates, subdir, sym, whole_word):
+        prefix = index_prefix(subdir)
+        regexp = whole_word_regexp(sym) if whole_word else None
+        if not self._case_sensitive:
+            sym = sym.lower()
+        for filename in candidates:
+            if not filename.startswith(prefix):
+                continue
+            try:
+                data = self._read_file(filename)
+            except (IOError, OSError):
+                # The file has been removed since it was indexed.
+                continue
+            if is_binary_data(data):
+                continue
+            if regexp is not None:
+                if regexp.search(data):
+                    yield filename[len(prefix):]
+                continue
+            if not self._case_sensitive:
+                data = data.lower()
+            if sym in data:
+                yield filename[len(prefix):]
+
+
+class SearchTimeout(Exception):
+
+    pass
+
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        # The processes have already exited.
+        pass
 
 
-# Remove the "./" prefix that "find" outputs.
-def tidy_filelist(iterable):
-    for filename in iterable:
-        if filename != ".":
-            assert filename.startswith("./")
-            yield filename[2:]
+class StopScope(object):
+
+    """The functions that stop the work a thread is blocked in, such as
+    reading from a subprocess, so that another thread can stop it.
+    parallel_chain() gives each of its worker threads a StopScope so
+    that it can stop them when its consumer goes away, rather than
+    waiting for them to notice between items."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stoppers = []
+        self._stopped = False
+
+    def add(self, stopper):
+        """Arranges for stop() to call stopper, or calls it now if stop()
+        has already been called."""
+        self._lock.acquire()
+        try:
+            if not self._stopped:
+                self._stoppers.append(stopper)
+                return
+        finally:
+            self._lock.release()
+        stopper()
+
+    def remove(self, stopper):
+        self._lock.acquire()
+        try:
+            if stopper in self._stoppers:
+                self._stoppers.remove(stopper)
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            stoppers = self._stoppers
+            self._stoppers = []
+        finally:
+            self._lock.release()
+        for stopper in stoppers:
+            stopper()
+
+
+# Holds the current thread's StopScope, if it has one, as "scope".
+thread_stop_scope = threading.local()
+
+
+def current_stop_scope():
+    return getattr(thread_stop_scope, "scope", None)
+
+
+def popen_filenames(args, timeout=None, **kwargs):
+    """Yields the lines output by the command.  If timeout is given and
+    the command runs for longer than that many seconds, it is killed
+    and SearchTimeout is raised."""
+    # The command runs in its own process group so that we can also
+    # stop the commands it runs, such as the pipelines in "sh -c".
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=1024,
+                            preexec_fn=os.setsid, **kwargs)
+    stopper = lambda: kill_process_group(proc)
+    scope = current_stop_scope()
+    if scope is not None:
+        scope.add(stopper)
+    timed_out = []
+    timer = None
+    if timeout is not None:
+        def on_timeout():
+            timed_out.append(True)
+            kill_process_group(proc)
+        timer = threading.Timer(timeout, on_timeout)
+        timer.setDaemon(True)
+        timer.start()
+    try:
+        # Iterating over the file itself would read ahead, and not
+        # yield anything until a buffer's worth of output had arrived.
+        for line in iter(proc.stdout.readline, ""):
+            yield line.rstrip("\n")
+        if len(timed_out) > 0:
+            raise SearchTimeout("%r took more than %s seconds"
+                                % (args, timeout))
+    finally:
+        if scope is not None:
+            scope.remove(stopper)
+        if timer is not None:
+            timer.cancel()
+        # If the consumer stopped early (for example, because the
+        # client went away and the WSGI server called close()), stop
+        # the processes rather than leaving them to run to completion.
+        if proc.poll() is None:
+            kill_process_group(proc)
+        proc.stdout.close()
+        proc.wait()
 
 
 class FSFileSet(FileSetBase):
 
-    def list_files(self, subdir):
-        # Note that with the sorting there is no pipelining, so we may
-        # as well do this in Python.
-        return tidy_filelist(popen_filenames(
-            ["sh", "-c", 'find -not -name "*.pyc" | sort'],
-            cwd=self._get_path(subdir)))
-
-    def grep_files(self, subdir, sym):
-        # Note that using "-i" makes this go a lot slower.
-        ci_arg = "" if self._case_sensitive else " -i"
-        return tidy_filelist(popen_filenames(
-            ["sh", "-c",
-             'find -not -name "*.pyc" '
-             '-and -not -name "*~" '
-             '-and -not -name "#*#" '
-             '-print0 | xargs --null grep -l "$1"' + ci_arg,
-             "-", sym],
-            cwd=self._get_path(subdir)))
+    def _read_file_list(self):
+        # Adding or removing a file changes its directory's mtime, so
+        # the directories' mtimes tell us when to reread the list.
+        paths = []
+        dir_mtimes = []
+        pending = [""]
+        while len(pending) > 0:
+            rel_dir = pending.pop()
+            dir_path = self._get_path(rel_dir)
+            try:
+                mtime = os.stat(dir_path).st_mtime
+                leafnames = os.listdir(dir_path)
+            except OSError:
+                continue
+            dir_mtimes.append((dir_path, mtime))
+            for leafname in leafnames:
+                if leafname.endswith(".pyc"):
+                    continue
+                rel_path = os.path.join(rel_dir, leafname)
+                paths.append(rel_path)
+                full_path = os.path.join(dir_path, leafname)
+                if os.path.isdir(full_path) and not os.path.islink(full_path):
+                    pending.append(rel_path)
+        return paths, dir_mtimes
+
+    def _file_list_changed(self, dir_mtimes):
+        for dir_path, mtime in dir_mtimes:
+            try:
+                if os.stat(dir_path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _is_indexable(self, filename):
+        # These files are also skipped by grep_files.
+        leafname = os.path.basename(filename)
+        return not (leafname.endswith(".pyc") or
+                    leafname.endswith("~") or
+                    (leafname.startswith("#") and leafname.endswith("#")))
 
 
 class GitFileSet(FileSetBase):
 
-    def list_files(self, subdir):
-        return popen_filenames(["git", "ls-files"],
-                               cwd=self._get_path(subdir))
-
-    def grep_files(self, subdir, sym):
-        ci_arg = [] if self._case_sensitive else ["-i"]
+    def _tree_revision(self, subdir):
+        proc = subprocess.Popen(["git", "rev-parse", "HEAD"],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=self._dir_path)
+        head = proc.communicate()[0].strip()
+        # Git's index changes when files are checked out or staged.
+        # git grep also searches unstaged changes, so the modified
+        # files' mtimes and sizes are included too.
+        return (head, self._git_index_mtime(),
+                tuple(sorted(self._modified_files().iteritems())))
+
+    def _index_stamps(self):
+        # Use the blob IDs from Git's index so that we don't have to
+        # stat every file.  Those only describe the working tree's
+        # files if they are unmodified, so the files that Git reports
+        # as modified are stamped by their mtime and size instead.
+        modified = self._modified_files()
+        stamps = {}
+        for line in popen_filenames(["git", "ls-files", "-s"],
+                                    cwd=self._dir_path):
+            info, filename = line.split("\t", 1)
+            mode, blob_id, stage = info.split()
+            # Skip symlinks and submodules.
+            if mode not in ("100644", "100755"):
+                continue
+            if filename not in modified:
+                stamps[filename] = blob_id
+            elif modified[filename] is not None:
+                stamps[filename] = modified[filename]
+        return stamps
+
+    def _modified_files(self):
+        """Returns a dict mapping the files in the working tree that
+        differ from Git's index to their mtime and size, or to None if
+        they have been deleted."""
+        modified = {}
+        for filename in popen_filenames(["git", "ls-files", "-m"],
+                                        cwd=self._dir_path):
+            try:
+                st = self.stat_path(filename)
+            except OSError:
+                modified[filename] = None
+                continue
+            modified[filename] = (st.st_mtime, st.st_size)
+        return modified
+
+    def _git_index_mtime(self):
+        try:
+            return os.stat(os.path.join(self._dir_path, ".git",
+                                        "index")).st_mtime
+        except OSError:
+            return None
+
+    def _read_file_list(self):
+        # "git ls-files" only changes when Git's index does.
+        index_mtime = self._git_index_mtime()
+        paths = list(popen_filenames(["git", "ls-files"],
+                                     cwd=self._dir_path))
+        return paths, index_mtime
+
+    def _file_list_changed(self, index_mtime):
+        return self._git_index_mtime() != index_mtime
+
+    def _grep_files(self, subdir, sym, whole_word):
+        # git grep searches files on several threads itself.
         return popen_filenames(
-            ["git", "grep"] + ci_arg + ["--text", "-l", sym],
-            cwd=self._get_path(subdir))
+            ["git", "grep", "--threads=%i" % self._search_processes] +
+            self._grep_mode_args(whole_word) + ["-I", "-l", sym],
+            cwd=self._get_path(subdir), timeout=self._search_timeout)
 
 
 svn_find = os.path.join(os.path.abspath(os.path.dirname(__file__)), "svn-find")
@@ -173,22 +1748,130 @@ svn_find = os.path.join(os.path.abspath(os.path.dirname(__file__)), "svn-find")
 
 class SVNFileSet(FileSetBase):
 
-    def list_files(self, subdir):
-        return popen_filenames([svn_find], cwd=self._get_path(subdir))
-
-    def grep_files(self, subdir, sym):
-        ci_arg = "" if self._case_sensitive else "-i"
-        return popen_filenames(
-            ["sh", "-c",
-             '%s | xargs grep -l "$1" %s' % (svn_find, ci_arg),
-             "-", sym],
-            cwd=self._get_path(subdir))
+    # Created when first needed, if pysvn is available.
+    _svn_client = None
+
+    def _svn_metadata_mtimes(self):
+        mtimes = []
+        for leafname in (".svn", ".svn/entries", ".svn/wc.db"):
+            try:
+                mtimes.append(os.stat(os.path.join(self._dir_path,
+                                                   leafname)).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def _read_file_list(self):
+        mtimes = self._svn_metadata_mtimes()
+        if pysvn is None:
+            paths = list(popen_filenames([svn_find], cwd=self._dir_path))
+        else:
+            paths = self._svn_status_files()
+        return paths, mtimes
+
+    def _svn_status_files(self):
+        # This does the same as svn-find, but in-process, which saves
+        # starting Python and importing pysvn each time the list of
+        # files is reread.  It is only called with _file_list_lock held,
+        # so the client is not shared between threads.
+        if self._svn_client is None:
+            self._svn_client = pysvn.Client()
+        root = os.path.abspath(self._dir_path)
+        paths = []
+        for status in self._svn_client.status(root):
+            rel_path = os.path.relpath(status["path"], root)
+            if (status["is_versioned"] and
+                status["text_status"] != pysvn.wc_status_kind.ignored and
+                rel_path != "."):
+                paths.append(rel_path)
+        return paths
+
+    def _file_list_changed(self, mtimes):
+        return self._svn_metadata_mtimes() != mtimes
+
+
+def parallel_chain(funcs, num_threads):
+    """Like itertools.chain(*[func() for func in funcs]), except that
+    the functions are called and their results consumed on a pool of
+    up to num_threads threads.  The results are still yielded in order,
+    and those of the first function are yielded as soon as they are
+    produced.  If the consumer stops early, the subprocesses that the
+    threads are reading from are stopped."""
+    jobs = Queue.Queue()
+    results = []
+    for func in funcs:
+        output = Queue.Queue()
+        jobs.put((func, output))
+        results.append(output)
+    # Set if the consumer goes away, to stop the workers early.
+    cancelled = threading.Event()
+    scopes = []
+
+    def worker(scope):
+        thread_stop_scope.scope = scope
+        while True:
+            try:
+                func, output = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            # Once cancelled, the remaining jobs are finished without
+            # being run, so that nothing waits for them.
+            if not cancelled.isSet():
+                try:
+                    items = func()
+                    try:
+                        for item in items:
+                            if cancelled.isSet():
+                                break
+                            output.put(("item", item))
+                    finally:
+                        if hasattr(items, "close"):
+                            items.close()
+                except Exception, exc:
+                    output.put(("error", exc))
+            output.put(("done", None))
+
+    def stop():
+        cancelled.set()
+        for scope in scopes:
+            scope.stop()
+
+    for i in range(min(num_threads, len(results))):
+        scope = StopScope()
+        scopes.append(scope)
+        thread = threading.Thread(target=worker, args=(scope,))
+        thread.setDaemon(True)
+        thread.start()
+    # If we are running on another parallel_chain()'s worker, stopping
+    # that worker stops ours too.
+    parent_scope = current_stop_scope()
+    if parent_scope is not None:
+        parent_scope.add(stop)
+    try:
+        for output in results:
+            while True:
+                kind, value = output.get()
+                if kind == "done":
+                    break
+                elif kind == "error":
+                    raise value
+                yield value
+    finally:
+        if parent_scope is not None:
+            parent_scope.remove(stop)
+        # Called from the consumer's thread, this kills the processes
+        # that the workers are blocked reading from.
+        stop()
 
 
 class CombinedFileSet(object):
 
-    def __init__(self, filesets):
+    def __init__(self, filesets, num_threads=8):
         self._filesets = filesets
+        # Number of member FileSets to grep at the same time.
+        self._num_threads = num_threads
+        # (members' file lists, PathIndex of the combined list), or None.
+        self._path_index = None
 
     def _delegate(self, attr, filename, *args):
         assert filename != ""
@@ -208,37 +1891,140 @@ class CombinedFileSet(object):
     def open_file(self, filename):
         return self._delegate("open_file", filename)
 
+    def list_dir_entries(self, filename):
+        if filename == "":
+            return [(subdir, True, None)
+                    for subdir in sorted(self._filesets.keys())]
+        return self._delegate("list_dir_entries", filename)
+
     def stat_path(self, filename):
         return self._delegate("stat_path", filename)
 
+    def get_file_links(self, filename):
+        return self._delegate("get_file_links", filename)
+
+    def get_line_offsets(self, filename):
+        return self._delegate("get_line_offsets", filename)
+
+    def file_kind(self, filename):
+        return self._delegate("file_kind", filename)
+
+    def start_indexer(self):
+        for subdir, fileset in sorted(self._filesets.iteritems()):
+            fileset.start_indexer()
+
+    def stop_indexer(self):
+        for subdir, fileset in sorted(self._filesets.iteritems()):
+            fileset.stop_indexer()
+
+    def note_viewed(self, dir_path):
+        if dir_path != "":
+            self._delegate("note_viewed", dir_path)
+
     def _list_all(self):
         for subdir, fileset in sorted(self._filesets.iteritems()):
             yield subdir
             for rel_path in fileset.list_files(""):
                 yield os.path.join(subdir, rel_path)
 
-    def _grep_all(self, sym):
-        for subdir, fileset in sorted(self._filesets.iteritems()):
-            for rel_path in fileset.grep_files("", sym):
+    def get_path_index(self):
+        # The members return the same list objects until their file
+        # lists change, so we only need to rebuild if any of them does.
+        sources = [fileset.list_files("")
+                   for subdir, fileset in sorted(self._filesets.iteritems())]
+        cached = self._path_index
+        if (cached is None or
+            len([1 for old, new in zip(cached[0], sources)
+                 if old is not new]) > 0):
+            cached = (sources, PathIndex(list(self._list_all())))
+            self._path_index = cached
+        return cached[1]
+
+    def _grep_all(self, sym, whole_word):
+        def grep_fileset(subdir, fileset):
+            for rel_path in fileset.grep_files("", sym, whole_word):
                 yield os.path.join(subdir, rel_path)
+        return parallel_chain(
+            [functools.partial(grep_fileset, subdir, fileset)
+             for subdir, fileset in sorted(self._filesets.iteritems())],
+            self._num_threads)
+
+    def _grep_lines_all(self, sym, whole_word, all_lines):
+        def grep_fileset(subdir, fileset):
+            for rel_path, line_no, line in fileset.grep_lines(
+                    "", sym, whole_word, all_lines):
+                yield os.path.join(subdir, rel_path), line_no, line
+        return parallel_chain(
+            [functools.partial(grep_fileset, subdir, fileset)
+             for subdir, fileset in sorted(self._filesets.iteritems())],
+            self._num_threads)
+
+    def _symbol_matches_all(self, sym):
+        matches = []
+        for subdir, fileset in sorted(self._filesets.iteritems()):
+            got = fileset.symbol_matches("", sym)
+            if got is None:
+                return None
+            matches.extend((os.path.join(subdir, rel_path), line_nos)
+                           for rel_path, line_nos in got)
+        return matches
+
+    def _related_symbols_all(self, sym):
+        syms_found = {}
+        syms_found_ci = {}
+        for subdir, fileset in sorted(self._filesets.iteritems()):
+            got = fileset.related_symbols("", sym)
+            if got is None:
+                return None
+            for counts, got_counts in zip((syms_found, syms_found_ci), got):
+                for symbol, count in got_counts.iteritems():
+                    counts[symbol] = counts.get(symbol, 0) + count
+        return syms_found, syms_found_ci
 
     def list_files(self, filename):
         if filename == "":
             return self._list_all()
         return self._delegate("list_files", filename)
 
-    def grep_files(self, filename, sym):
+    def grep_files(self, filename, sym, whole_word=False):
+        if filename == "":
+            return self._grep_all(sym, whole_word)
+        return self._delegate("grep_files", filename, sym, whole_word)
+
+    def grep_lines(self, filename, sym, whole_word=False, all_lines=False):
+        if filename == "":
+            return self._grep_lines_all(sym, whole_word, all_lines)
+        return self._delegate("grep_lines", filename, sym, whole_word,
+                              all_lines)
+
+    def revision(self, filename):
         if filename == "":
-            return self._grep_all(sym)
-        return self._delegate("grep_files", filename, sym)
+            return tuple(fileset.revision("") for subdir, fileset
+                         in sorted(self._filesets.iteritems()))
+        return self._delegate("revision", filename)
+
+    def symbol_matches(self, filename, sym):
+        if filename == "":
+            return self._symbol_matches_all(sym)
+        return self._delegate("symbol_matches", filename, sym)
+
+    def related_symbols(self, filename, sym):
+        if filename == "":
+            return self._related_symbols_all(sym)
+        return self._delegate("related_symbols", filename, sym)
 
 
-def sym_search_in_filenames(fileset, url_root, subdir, sym):
+def sym_search_in_filenames(fileset, url_root, subdir, sym, limit):
     sym_regexp = re.compile(re.escape(sym), re.IGNORECASE)
     yield "<pre class=code>"
+    count = 0
     for filename in fileset.list_files(subdir):
         match = sym_regexp.search(filename)
         if match:
+            count += 1
+            if count > limit:
+                yield "(more filenames not shown)\n"
+                break
             text = ("%s<strong>%s</strong>%s"
                     % (cgi.escape(filename[:match.start()]),
                        cgi.escape(match.group()),
@@ -248,12 +2034,51 @@ def sym_search_in_filenames(fileset, url_root, subdir, sym):
     yield "</pre>"
 
 
+def highlight_positions(text, positions):
+    matched = set(positions)
+    parts = []
+    for is_match, chars in itertools.groupby(
+        enumerate(text), lambda (i, char): i in matched):
+        escaped = cgi.escape("".join(char for i, char in chars))
+        if is_match:
+            parts.append("<strong>%s</strong>" % escaped)
+        else:
+            parts.append(escaped)
+    return "".join(parts)
+
+
+# Maximum number of results shown by the /find page.
+find_results_limit = 50
+
+
+def find_files(fileset, url_root, query):
+    for x in stylesheet(url_root):
+        yield x
+    out = HTMLWriter()
+    # Attribute values are in single quotes.
+    escaped = cgi.escape(query, True).replace("'", "&#39;")
+    write_page_header(out, url_root, "find: " + escaped, "", "", "")
+    out.start("div", [("class", "box")])
+    out.start("form", [("action", "%s/find" % url_root), ("method", "get")])
+    out.element("input", [("type", "text"), ("name", "q"),
+                          ("value", escaped)])
+    out.element("button", [("type", "submit")], "Find file")
+    out.end("form")
+    out.end("div")
+    yield out.take()
+    yield "<pre class=code>"
+    for path, positions in fileset.get_path_index().find(query,
+                                                         find_results_limit):
+        yield ("<a href='%s/file/%s'>%s</a>\n"
+               % (url_root, path, highlight_positions(path, positions)))
+    yield "</pre>"
+
+
 class SymSearch(object):
 
     def __init__(self, subdir, sym):
         self._subdir = subdir
         self._sym = sym
-        self._sym_regexp = re.compile(re.escape(sym))
         self._sym_regexp_ci = re.compile(re.escape(sym), re.IGNORECASE)
         self.syms_found = {}
         self.syms_found_ci = {}
@@ -261,236 +2086,587 @@ class SymSearch(object):
     def match_line(self, url_root, line):
         """Tells you whether the line matches and returns a formatted version
         of the line with the matches highlighted."""
+        return self.match_tokens(url_root, split_tokens(line))
+
+    def match_tokens(self, url_root, parts):
+        """Like match_line, but takes the line as split by split_tokens."""
         does_match = False
         line_out = []
-        for token, is_symbol in tokens(line):
+        is_symbol = False
+        for token in parts:
             if token == self._sym:
                 line_out.append("<strong>%s</strong>" % token)
                 does_match = True
             elif is_symbol:
                 line_out.append(link_token(url_root, self._subdir, token))
-                if self._sym_regexp.search(token):
-                    self.syms_found[token] = \
-                        self.syms_found.get(token, 0) + 1
-                elif self._sym_regexp_ci.search(token):
-                    self.syms_found_ci[token] = \
-                        self.syms_found_ci.get(token, 0) + 1
             else:
                 line_out.append(cgi.escape(token))
+            is_symbol = not is_symbol
         return (does_match, line_out)
 
-    def match_lines(self, url_root, lines):
-        for line_no, line in enumerate(lines):
-            line = line.rstrip("\n\r")
-            # Regexp search is an optimisation: could be removed
-            if self._sym_regexp_ci.search(line):
-                does_match, line_out = self.match_line(url_root, line)
-                if does_match:
-                    yield (line_no, line_out)
+    def count_symbols(self, parts):
+        """Counts the other symbols in the line, as split by split_tokens,
+        that contain sym, in syms_found and syms_found_ci."""
+        for token in parts[1::2]:
+            if token == self._sym:
+                continue
+            if self._sym in token:
+                self.syms_found[token] = self.syms_found.get(token, 0) + 1
+            elif self._sym_regexp_ci.search(token):
+                self.syms_found_ci[token] = \
+                    self.syms_found_ci.get(token, 0) + 1
+
+
+def grep_matches(fileset, matcher, url_root, subdir, sym, done_files):
+    """Yields (filename, line number, formatted line) for each line that
+    matches sym.  Only the files that contain sym as a whole symbol are
+    searched.  The symbols in these files' lines that contain sym
+    ignoring case are counted in matcher, for the "Other symbols found"
+    list, and the files whose lines have all been counted are added to
+    done_files."""
+    lines = fileset.grep_lines(subdir, sym, whole_word=True, all_lines=True)
+    current_file = None
+    try:
+        for rel_filename, line_no, line in lines:
+            if rel_filename != current_file:
+                if current_file is not None:
+                    done_files.add(current_file)
+                current_file = rel_filename
+            parts = split_tokens(line)
+            matcher.count_symbols(parts)
+            does_match, line_out = matcher.match_tokens(url_root, parts)
+            if does_match:
+                yield (rel_filename, line_no, line_out)
+        # The last file is only finished if we weren't closed early.
+        if current_file is not None:
+            done_files.add(current_file)
+    finally:
+        # Stops the grep if we are closed before reaching the end.
+        if hasattr(lines, "close"):
+            lines.close()
+
+
+# Maximum number of lines that grep_related_symbols() reads.
+related_symbols_lines_limit = 2000
+
+
+def grep_related_symbols(fileset, matcher, subdir, sym, done_files):
+    """Counts the symbols for the "Other symbols found" list in matcher,
+    from up to related_symbols_lines_limit lines that contain sym
+    ignoring case.  The files in done_files, whose lines grep_matches()
+    has already counted, are not read again.  Returns False if it
+    stopped at the limit, before counting every line.  If the search
+    times out, SearchTimeout is raised and the symbols found so far are
+    left in matcher."""
+    regexp = line_regexp(sym, False)
+    filenames = fileset.grep_files(subdir, sym)
+    count = 0
+    try:
+        for rel_filename in filenames:
+            if rel_filename in done_files:
+                continue
+            fh = fileset.open_file(os.path.join(subdir, rel_filename))
+            try:
+                for line in fh:
+                    if regexp.search(line):
+                        matcher.count_symbols(split_tokens(line))
+                        count += 1
+                        if count >= related_symbols_lines_limit:
+                            return False
+            finally:
+                fh.close()
+    finally:
+        if hasattr(filenames, "close"):
+            filenames.close()
+    return True
+
+
+def indexed_matches(fileset, matcher, url_root, subdir, matches):
+    """Like grep_matches, but only formats the lines that the symbol
+    table lists in matches."""
+    for rel_filename, line_nos in matches:
+        wanted = set(line_nos)
+        fh = fileset.open_file(os.path.join(subdir, rel_filename))
+        try:
+            for line_no, line in enumerate(fh):
+                if line_no in wanted:
+                    does_match, line_out = matcher.match_line(
+                        url_root, line.rstrip("\n\r"))
+                    # The file may have changed since it was indexed.
+                    if does_match:
+                        yield (rel_filename, line_no, line_out)
+                if line_no >= line_nos[-1]:
+                    break
+        finally:
+            fh.close()
+
+
+# Default number of matching lines shown on each page of search results.
+search_results_limit = 1000
 
 
-def sym_search(fileset, url_root, subdir, sym):
-    for x in stylesheet():
+def sym_search(fileset, url_root, subdir, sym, offset=0,
+               limit=search_results_limit, on_timeout=None):
+    """Shows the matching lines numbered from offset to offset + limit,
+    with a link to the next page if there are more.  on_timeout, if
+    given, is called if the search times out and the page is
+    incomplete."""
+    for x in stylesheet(url_root):
         yield x
-    yield output_tag([tag("title", "symbol: ", sym),
-                      tagp("div", [("class", "box")],
-                           tag("div", breadcrumb_path(url_root, "")),
-                           tag("div", search_form(url_root, subdir, sym)))])
-    for x in sym_search_in_filenames(fileset, url_root, subdir, sym):
+    out = HTMLWriter()
+    write_page_header(out, url_root, "symbol: " + sym, "", subdir, sym)
+    yield out.take()
+    for x in sym_search_in_filenames(fileset, url_root, subdir, sym, limit):
         yield x
     matcher = SymSearch(subdir, sym)
-    yield "<div class=all_matches>"
-    for rel_filename in fileset.grep_files(subdir, sym):
-        filename = os.path.join(subdir, rel_filename)
-        file_matches = False
-        fh = fileset.open_file(filename)
-        for line_no, line_out in matcher.match_lines(url_root, fh):
+    # The files whose symbols grep_matches() has counted.
+    done_files = set()
+    indexed = fileset.symbol_matches(subdir, sym)
+    if indexed is None:
+        matches = grep_matches(fileset, matcher, url_root, subdir, sym,
+                               done_files)
+    else:
+        matches = indexed_matches(fileset, matcher, url_root, subdir, indexed)
+    # Send the page so far before waiting for grep.
+    yield Flush("<div class=all_matches>")
+    last_filename = None
+    shown = 0
+    more = False
+    timed_out = False
+    # Closing the generator stops any grep that is still running, both
+    # when the page is full and when we are closed ourselves because
+    # the client has gone away.
+    try:
+        for match_no, (rel_filename, line_no, line_out) in \
+                enumerate(matches):
+            if match_no < offset:
+                continue
+            if shown == limit:
+                more = True
+                break
+            shown += 1
             args = {"root": url_root,
                     "sym": sym,
                     "rel_file": rel_filename,
-                    "file": filename,
-                    "line_no": line_no + 1}
-            if not file_matches:
-                file_matches = True
+                    "file": os.path.join(subdir, rel_filename),
+                    "line_no": line_no + 1,
+                    "window": ""}
+            new_file = rel_filename != last_filename
+            if new_file:
+                last_filename = rel_filename
+                windowed = is_windowed(fileset, args["file"])
+            if windowed:
+                # Link to the window of lines that contains the match.
+                args["window"] = "&start=%i" % (window_start(line_no) + 1)
+            if new_file:
                 yield ("<a href='%(root)s/file/%(file)s?sym=%(sym)s"
-                       "#line%(line_no)i'>%(rel_file)s</a>:"
+                       "%(window)s#line%(line_no)i'>%(rel_file)s</a>:"
                        % args)
             yield "<div class='code matches_in_file'>"
             yield ("<a href='%(root)s/file/%(file)s?sym=%(sym)s"
-                   "#line%(line_no)i'>%(line_no)i</a>:"
+                   "%(window)s#line%(line_no)i'>%(line_no)i</a>:"
                    % args)
             for x in line_out:
                 yield x
             yield "</div>"
             yield "\n"
+    except SearchTimeout:
+        timed_out = True
+    finally:
+        matches.close()
     yield "</div>"
-    yield "<hr>Other symbols found:\n"
-    if (len(matcher.syms_found) == 0 and
-        len(matcher.syms_found_ci) == 0):
+    if timed_out:
+        out.element("div", [("class", "box")],
+                    "Search timed out: not all matches are shown")
+        yield out.take()
+    if more:
+        url = "%s&offset=%i&limit=%i" % (search_url(url_root, subdir, sym),
+                                         offset + limit, limit)
+        out.start("div", [("class", "box")])
+        out.element("a", [("href", url)], "more results")
+        out.end("div")
+        yield out.take()
+    if offset > 0:
+        # The "Other symbols found" list is only worked out for the
+        # first page, so that later pages cost no more than it.
+        if timed_out and on_timeout is not None:
+            on_timeout()
+        return
+    yield Flush("<hr>Other symbols found:\n")
+    related = None
+    complete = True
+    if indexed is not None:
+        related = fileset.related_symbols(subdir, sym)
+    if related is None:
+        # There is no index, or the background indexer has locked it
+        # since symbol_matches() was called.
+        try:
+            complete = grep_related_symbols(fileset, matcher, subdir, sym,
+                                            done_files)
+        except SearchTimeout:
+            timed_out = True
+            complete = False
+        related = matcher.syms_found, matcher.syms_found_ci
+    syms_found, syms_found_ci = related
+    if timed_out and on_timeout is not None:
+        on_timeout()
+    if len(syms_found) == 0 and len(syms_found_ci) == 0:
         yield "none"
     else:
-        if len(matcher.syms_found) > 0:
-            yield output_tag(format_sym_list(url_root, subdir,
-                                             matcher.syms_found))
-        if len(matcher.syms_found_ci) > 0:
+        if len(syms_found) > 0:
+            write_sym_list(out, url_root, subdir, syms_found)
+            yield out.take()
+        if len(syms_found_ci) > 0:
             yield "with case relaxed:\n"
-            yield output_tag(format_sym_list(url_root, subdir,
-                                             matcher.syms_found_ci))
-
-def format_sym_list(url_root, subdir, syms):
-    body = []
+            write_sym_list(out, url_root, subdir, syms_found_ci)
+            yield out.take()
+    if not complete:
+        out.element("div", [("class", "box")],
+                    "Not all lines were read: the list is incomplete")
+        yield out.take()
+
+def write_sym_list(out, url_root, subdir, syms):
+    out.start("ul")
     for symbol, count in sorted(syms.iteritems()):
         url = search_url(url_root, subdir, symbol)
-        body.append(tag("li", tagp("a", [("href", url)], symbol),
-                        " (%i)" % count))
-    return tag("ul", body)
-
-def show_file_or_dir(fileset, url_root, filename, subdir, query):
-    if fileset.is_dir(filename):
-        return show_dir(fileset, url_root, filename, subdir)
+        out.start("li")
+        out.element("a", [("href", url)], symbol)
+        out.write(" (%i)" % count)
+        out.end("li")
+    out.end("ul")
+
+def render_line(url_root, subdir, line_no, parts, matcher):
+    """Returns (whether the line matches, list of HTML chunks) for the
+    line, as split by split_lines_tokens.  matcher is a SymSearch, or
+    None if no symbol is being highlighted."""
+    if matcher is None:
+        html = ["<a name='line%i'>" % (line_no + 1)]
+        for i, token in enumerate(parts):
+            if i % 2 == 1:
+                html.append(link_token(url_root, subdir, token))
+            else:
+                html.append(cgi.escape(token))
+        return False, html
+    parts[-1] = parts[-1].rstrip("\n\r")
+    does_match, line_out = matcher.match_tokens(url_root, parts)
+    if does_match:
+        html = ["<span class=highlight>"]
     else:
-        return show_file(fileset, url_root, filename, subdir, query)
+        html = ["<span>"]
+    html.append("<a name='line%i'></a>" % (line_no + 1))
+    html.extend(line_out)
+    html.append("</span>\n")
+    return does_match, html
+
 
-def show_file(fileset, url_root, filename, subdir, query):
-    for x in stylesheet():
+def show_file(fileset, url_root, filename, subdir, query, window=None):
+    """Shows the file, or if window is given, the (start, count) window
+    of its lines chosen by file_window()."""
+    for x in stylesheet(url_root):
         yield x
-    links = [tag("div", tagp("a", [("href", url)], name))
-             for name, url in get_file_links(filename)]
-    yield output_tag([tag("title", filename),
-                      tagp("div", [("class", "box")],
-                           tag("div", breadcrumb_path(url_root, filename)),
-                           tag("div", search_form(url_root, subdir, "")),
-                           links)])
+    out = HTMLWriter()
+    write_page_header(out, url_root, filename, filename, subdir, "",
+                      fileset.get_file_links(filename))
+    yield out.take()
+    kind = fileset.file_kind(filename)
+    if kind == "binary":
+        out.element("div", [("class", "box")],
+                    "Binary file (%i bytes): not shown"
+                    % fileset.stat_path(filename).st_size)
+        yield out.take()
+        return
+    if window is not None:
+        # Huge files are always shown in windows.
+        for x in show_file_window(fileset, url_root, filename, subdir,
+                                  query, window, plain=kind == "huge"):
+            yield x
+        return
+    fh = fileset.open_file(filename)
+    try:
+        data = fh.read()
+    finally:
+        fh.close()
     if "sym" in query:
+        # The list of matching lines goes before the file's contents, so
+        # we buffer the rendered lines rather than tokenizing the file a
+        # second time.
         matcher = SymSearch(subdir, query["sym"])
         match_line_nos = []
-        fh = fileset.open_file(filename)
-        try:
-            for line_no, line in enumerate(fh):
-                does_match, line_out = matcher.match_line(url_root, line)
-                if does_match:
-                    match_line_nos.append(line_no)
-        finally:
-            fh.close()
-        yield output_tag(tagp("div", [("class", "box")],
-                              [[tagp("a", [("href", "#line%s" % (line_no + 1))],
-                                     str(line_no)),
-                                " "]
-                               for line_no in match_line_nos]))
+        rendered = []
+        for line_no, parts in enumerate(split_lines_tokens(data)):
+            does_match, html = render_line(url_root, subdir, line_no, parts,
+                                           matcher)
+            if does_match:
+                match_line_nos.append(line_no)
+            rendered.extend(html)
+        out.start("div", [("class", "box")])
+        for line_no in match_line_nos:
+            out.element("a", [("href", "#line%s" % (line_no + 1))],
+                        str(line_no))
+            out.write(" ")
+        out.end("div")
+        yield out.take()
+        yield "<pre class=code>"
+        for x in rendered:
+            yield x
+        yield "</pre>"
+    else:
+        yield "<pre class=code>"
+        for line_no, parts in enumerate(split_lines_tokens(data)):
+            for x in render_line(url_root, subdir, line_no, parts, None)[1]:
+                yield x
+        yield "</pre>"
 
-        matcher = SymSearch(subdir, query["sym"])
-        fh = fileset.open_file(filename)
-        try:
-            yield "<pre class=code>"
-            for line_no, line in enumerate(fh):
-                line = line.rstrip("\n\r")
-                does_match, line_out = matcher.match_line(url_root, line)
-                if does_match:
-                    yield "<span class=highlight>"
-                else:
-                    yield "<span>"
-                yield "<a name='line%i'></a>" % (line_no + 1)
-                for x in line_out:
-                    yield x
-                yield "</span>\n"
-            yield "</pre>"
-        finally:
-            fh.close()
+
+# Files bigger than this many bytes are shown a window of lines at a
+# time, so that browsers don't have to lay out huge pages.
+windowed_file_size = 1 << 20
+# Default number of lines in each window.
+file_window_lines = 2000
+
+
+def file_window(size, query):
+    """Returns None if the whole file should be shown, otherwise the
+    (start, count) of the window of lines to show, counting lines from
+    0.  The query's "start" counts lines from 1, like the #lineN
+    anchors.  Raises ValueError if "start" or "count" is not an
+    integer."""
+    if ("start" not in query and "count" not in query and
+        size <= windowed_file_size):
+        return None
+    # Larger windows would let huge files be shown whole.
+    count = min(max(int(query.get("count", file_window_lines)), 1),
+                file_window_lines)
+    start = max(int(query.get("start", 1)) - 1, 0)
+    return (start, count)
+
+
+def window_start(line_no, count=file_window_lines):
+    """Returns the start of the window of count lines that contains the
+    line, with windows starting at multiples of count."""
+    return line_no - line_no % count
+
+
+def is_windowed(fileset, filename):
+    try:
+        return fileset.stat_path(filename).st_size > windowed_file_size
+    except OSError:
+        return False
+
+
+def file_window_url(url_root, filename, sym, start, count):
+    url = "%s/file/%s?start=%i&count=%i" % (url_root, filename, start + 1,
+                                           count)
+    if sym is not None:
+        url += "&sym=%s" % sym
+    return url
+
+
+def line_offsets(fh):
+    """Returns an array of the offsets in the file at which its lines
+    start, followed by the file's size, so that line i is the bytes
+    from offsets[i] to offsets[i + 1]."""
+    offsets = array.array("L", [0])
+    pos = 0
+    while True:
+        block = fh.read(64 * 1024)
+        if len(block) == 0:
+            break
+        index = block.find("\n")
+        while index != -1:
+            offsets.append(pos + index + 1)
+            index = block.find("\n", index + 1)
+        pos += len(block)
+    if offsets[-1] != pos:
+        # The last line has no newline.
+        offsets.append(pos)
+    return offsets
+
+
+def symbol_line_nos(data, sym, offsets):
+    """Returns the numbers of the lines in data that SymSearch would
+    match, without tokenizing the lines that don't contain sym."""
+    line_nos = []
+    for match in whole_word_regexp(sym).finditer(data):
+        line_no = bisect.bisect_right(offsets, match.start()) - 1
+        if len(line_nos) > 0 and line_nos[-1] == line_no:
+            continue
+        line = data[offsets[line_no]:offsets[line_no + 1]]
+        if sym in split_tokens(line)[1::2]:
+            line_nos.append(line_no)
+    return line_nos
+
+
+def render_plain_line(line_no, line, does_match):
+    """Like render_line, but doesn't tokenize the line, for files that
+    are too big to render fully."""
+    html = ["<a name='line%i'></a>" % (line_no + 1), cgi.escape(line)]
+    if does_match:
+        html = ["<span class=highlight>"] + html + ["</span>"]
+    return html
+
+
+def show_file_window(fileset, url_root, filename, subdir, query, window,
+                     plain=False):
+    start, count = window
+    sym = query.get("sym")
+    offsets = fileset.get_line_offsets(filename)
+    num_lines = len(offsets) - 1
+    end = min(start + count, num_lines)
+    start = min(start, end)
+    out = HTMLWriter()
+    line_nos = []
+    fh = fileset.open_file(filename)
+    try:
+        if sym is not None:
+            # The jump links cover the whole file.  Those for lines
+            # outside this window go to the window containing the line.
+            line_nos = symbol_line_nos(fh.read(), sym, offsets)
+            out.start("div", [("class", "box")])
+            for line_no in line_nos:
+                url = "#line%i" % (line_no + 1)
+                if not start <= line_no < end:
+                    url = file_window_url(
+                        url_root, filename, sym,
+                        window_start(line_no, count), count) + url
+                out.element("a", [("href", url)], str(line_no))
+                out.write(" ")
+            out.end("div")
+        fh.seek(offsets[start])
+        data = fh.read(offsets[end] - offsets[start])
+    finally:
+        fh.close()
+    out.start("div", [("class", "box")])
+    out.write("Lines %i-%i of %i " % (start + 1, end, num_lines))
+    if start > 0:
+        out.element("a", [("href", file_window_url(
+                    url_root, filename, sym, max(start - count, 0), count))],
+                    "previous")
+        out.write(" ")
+    if end < num_lines:
+        out.element("a", [("href", file_window_url(
+                    url_root, filename, sym, end, count))],
+                    "next")
+    out.end("div")
+    yield out.take()
+    yield "<pre class=code>"
+    if plain:
+        highlighted = set(line_nos)
+        for line_no, line in enumerate(data.splitlines(True), start):
+            for x in render_plain_line(line_no, line,
+                                       line_no in highlighted):
+                yield x
     else:
-        fh = fileset.open_file(filename)
-        try:
-            yield "<pre class=code>"
-            for line_no, line in enumerate(fh):
-                yield "<a name='line%i'>" % (line_no + 1)
-                for token, is_symbol in tokens(line):
-                    if is_symbol:
-                        yield link_token(url_root, subdir, token)
-                    else:
-                        yield cgi.escape(token)
-            yield "</pre>"
-        finally:
-            fh.close()
+        matcher = None
+        if sym is not None:
+            matcher = SymSearch(subdir, sym)
+        for i, parts in enumerate(split_lines_tokens(data)):
+            for x in render_line(url_root, subdir, start + i, parts,
+                                 matcher)[1]:
+                yield x
+    yield "</pre>"
 
 def show_dir(fileset, url_root, path, subdir):
     title = path if path != "" else "[top]"
-    for x in stylesheet():
+    for x in stylesheet(url_root):
         yield x
-    yield output_tag([tag("title", title),
-                      tagp("div", [("class", "box")],
-                           tag("div", breadcrumb_path(url_root, path)),
-                           tag("div", search_form(url_root, subdir, "")))])
-    def format_entry(leafname):
-        pathname = os.path.join(path, leafname)
-        if fileset.is_dir(pathname):
-            size = ""
+    out = HTMLWriter()
+    write_page_header(out, url_root, title, path, subdir, "")
+    # Send the header before listing what may be a big directory.
+    yield Flush(out.take())
+    write_breadcrumb_path(out, url_root, path)
+    out.start("table", [("class", "dirlist")])
+    out.start("tr")
+    out.element("th", [("class", "file-size")], "size")
+    out.element("th", [("class", "file-name")], "name")
+    out.end("tr")
+    for leafname, is_dir, size in fileset.list_dir_entries(path):
+        if exclude(leafname):
+            continue
+        if is_dir:
             leafname += "/"
-        else:
-            st = fileset.stat_path(pathname)
-            size = str(st.st_size)
-        return tag("tr",
-                   tagp("td", [("class", "file-size")], size),
-                   tagp("td", [("class", "file-name")],
-                        tagp("a", [("href", leafname)], leafname)))
-    yield output_tag([breadcrumb_path(url_root, path),
-                      tagp("table", [("class", "dirlist")],
-                           tag("tr",
-                               tagp("th", [("class", "file-size")], "size"),
-                               tagp("th", [("class", "file-name")], "name")),
-                           [format_entry(leafname)
-                            for leafname in sorted(fileset.list_dir(path))
-                            if not exclude(leafname)])])
+        size = str(size) if size is not None else ""
+        out.start("tr")
+        out.element("td", [("class", "file-size")], size)
+        out.start("td", [("class", "file-name")])
+        out.element("a", [("href", leafname)], leafname)
+        out.end("td")
+        out.end("tr")
+        # Send large listings in pieces rather than all at the end.
+        if out.size() >= stream_chunk_size:
+            yield Flush(out.take())
+    out.end("table")
+    yield out.take()
+
+exclude_regexp = re.compile(r"\.pyc$|^#.*#$|~")
 
 def exclude(leafname):
-    regexps = [r"\.pyc$",
-               r"^#.*#$",
-               r"~"]
-    for regexp in regexps:
-        if re.search(regexp, leafname):
-            return True
-    return False
-
-
-def search_form(url_root, subdir, default_sym):
+    return exclude_regexp.search(leafname) is not None
+
+
+def write_page_header(out, url_root, title, path, subdir, default_sym,
+                      links=()):
+    out.element("title", [], title)
+    out.start("div", [("class", "box")])
+    out.start("div")
+    write_breadcrumb_path(out, url_root, path)
+    out.end("div")
+    out.start("div")
+    write_search_form(out, url_root, subdir, default_sym)
+    out.end("div")
+    for name, url in links:
+        out.start("div")
+        out.element("a", [("href", url)], name)
+        out.end("div")
+    out.end("div")
+
+def write_search_form(out, url_root, subdir, default_sym):
     script = """
 window.onload = function () {
     document.getElementById("form_field").focus();
 }
 """
-    return tagp("form", [("action", "%s/search" % url_root),
-                         ("method", "get")],
-                tagp("input", [("type", "hidden"),
-                               ("name", "dir"),
-                               ("value", subdir)]),
-                tagp("input", [("id", "form_field"),
-                               ("type", "text"),
-                               ("name", "sym"),
-                               ("value", default_sym)]),
-                tagp("button", [("type", "submit")],
-                     "Go"),
-                tagp("script", [("language", "javascript")], script))
-
-def breadcrumb_path(url_root, path):
-    crumbs = [tagp("a", [("href", "%s/file/" % url_root)], "[top]")]
+    out.start("form", [("action", "%s/search" % url_root),
+                       ("method", "get")])
+    out.element("input", [("type", "hidden"),
+                          ("name", "dir"),
+                          ("value", subdir)])
+    out.element("input", [("id", "form_field"),
+                          ("type", "text"),
+                          ("name", "sym"),
+                          ("value", default_sym)])
+    out.element("button", [("type", "submit")], "Go")
+    out.element("script", [("language", "javascript")], script)
+    out.end("form")
+
+def write_breadcrumb_path(out, url_root, path):
+    out.element("a", [("href", "%s/file/" % url_root)], "[top]")
     path_got = ""
     for element in path.split("/"):
         path_got = os.path.join(path_got, element)
-        crumbs.append(["/",
-                       tagp("a", [("href", "%s/file/%s" % (url_root, path_got))],
-                            cgi.escape(element))])
-    return crumbs
-
-def tokens(line):
-    regexp = re.compile("(.*?)([A-Za-z0-9_]+)")
-    i = 0
-    while True:
-        m = regexp.match(line, i)
-        if m:
-            yield (m.group(1), False)
-            yield (m.group(2), True)
-            i = m.end()
-        else:
-            yield (line[i:], False)
-            return
+        out.write("/")
+        out.element("a", [("href", "%s/file/%s" % (url_root, path_got))],
+                    cgi.escape(element))
+
+def split_tokens(line):
+    """Splits a line into a list that alternates between non-symbol text
+    and symbols.  The even-indexed elements are the text between
+    symbols (possibly empty) and the odd-indexed ones are the symbols.
+    The tokens are substrings of the line, as the renderers use them,
+    and are found with a single call into the regexp engine."""
+    return symbol_regexp.split(line)
+
+
+def split_lines_tokens(data):
+    """Returns split_tokens() of each line of a whole file's contents.
+    Each line keeps its newline, as when iterating over a file."""
+    # This is quicker than splitting the whole file with one regexp
+    # call and then finding the newlines in the non-symbol text.
+    lines = data.split("\n")
+    result = [symbol_regexp.split(line + "\n") for line in lines[:-1]]
+    if lines[-1] != "":
+        result.append(symbol_regexp.split(lines[-1]))
+    return result
 
 
 def search_url(url_root, subdir, symbol):
@@ -502,31 +2678,44 @@ def link_token(url_root, subdir, token):
     return "<a href='%s'>%s</a>" % (url, token)
 
 
-def tag(tag, *body):
-    return ("<%s>" % tag,
-            body,
-            "</%s>" % tag)
-
-def tagp(tag, attrs, *body):
-    return ("<%s%s>" % (tag,
-                        "".join(map(lambda (key, val):
-                                        " %s='%s'" % (key, val),
-                                    attrs))),
-            body,
-            "</%s>" % tag)
-
-def output_tag(val):
-    out = StringIO.StringIO()
-    def f(x):
-        if isinstance(x, str):
-            out.write(x)
-        elif isinstance(x, tuple) or isinstance(x, list):
-            for y in x:
-                f(y)
-        else:
-            raise TypeError(x)
-    f(val)
-    return out.getvalue()
+# Size at which long pages are sent on rather than buffered further.
+stream_chunk_size = 16 * 1024
+
+
+class HTMLWriter(object):
+
+    """Accumulates HTML markup so that pages can be sent in pieces as
+    they are generated.  Attribute values are not escaped."""
+
+    def __init__(self):
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+
+    def start(self, tag, attrs=()):
+        self.write("<%s%s>" % (tag, "".join(" %s='%s'" % (key, val)
+                                            for key, val in attrs)))
+
+    def end(self, tag):
+        self.write("</%s>" % tag)
+
+    def element(self, tag, attrs=(), text=""):
+        self.start(tag, attrs)
+        self.write(text)
+        self.end(tag)
+
+    def size(self):
+        return self._size
+
+    def take(self):
+        """Returns the markup written so far and empties the buffer."""
+        data = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        return data
 
 
 def path_splits(filename):
@@ -535,14 +2724,6 @@ def path_splits(filename):
         yield ("/".join(parts[:i]),
                "/".join(parts[i:]))
 
-def get_file_links(filename):
-    for part1, part2 in path_splits(filename):
-        link_file = os.path.join(part1, "crossrefs.sbrowse")
-        if os.path.exists(link_file):
-            for line in open(link_file, "r"):
-                name, url_pattern = line.split(":", 1)
-                yield (name, url_pattern % part2)
-
 
 def make_fileset(dir_path, **kwargs):
     if os.path.exists(os.path.join(dir_path, ".svn")):
@@ -553,6 +2734,72 @@ def make_fileset(dir_path, **kwargs):
         return FSFileSet(dir_path, **kwargs)
 
 
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+
+    """WSGI server that handles requests on a fixed pool of threads, so
+    that a slow search doesn't hold up other users' requests."""
+
+    def __init__(self, server_address, handler_class, num_threads):
+        wsgiref.simple_server.WSGIServer.__init__(self, server_address,
+                                                  handler_class)
+        self._requests = Queue.Queue()
+        self._num_threads = num_threads
+
+    def serve_forever(self, *args):
+        # The threads are started here rather than in the constructor
+        # so that they exist in each process started by serve_forked().
+        for i in range(self._num_threads):
+            thread = threading.Thread(target=self._serve_requests)
+            thread.setDaemon(True)
+            thread.start()
+        wsgiref.simple_server.WSGIServer.serve_forever(self, *args)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _serve_requests(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+
+def make_server(port, handler, num_threads=1):
+    if num_threads > 1:
+        server_class = functools.partial(ThreadPoolWSGIServer,
+                                         num_threads=num_threads)
+    else:
+        server_class = wsgiref.simple_server.WSGIServer
+    return wsgiref.simple_server.make_server("", port, handler,
+                                             server_class=server_class)
+
+
+def serve_forked(httpd, num_processes):
+    """Serves requests from num_processes child processes, which all
+    accept connections on httpd's listening socket."""
+    pids = []
+    try:
+        for i in range(num_processes):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    httpd.serve_forever()
+                finally:
+                    os._exit(1)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
 def main(argv):
     parser = optparse.OptionParser()
     parser.add_option("--dir", "-d", dest="dir_path", default=".",
@@ -566,19 +2813,83 @@ def main(argv):
     parser.add_option("--cs", "--case-sensitive", dest="case_sensitive",
                       action="store_true",
                       help="Grep for symbols case-sensitively (faster)")
+    parser.add_option("--index-dir", dest="index_dir", default=None,
+                      help="Directory in which to keep search indexes "
+                      "(makes searching large trees faster)")
+    parser.add_option("--index-daemon", dest="index_daemon",
+                      action="store_true",
+                      help="Keep the search index up to date in a "
+                      "background thread (requires --index-dir)")
+    parser.add_option("--threads", dest="num_threads", default=1,
+                      type="int",
+                      help="Number of threads to serve requests with")
+    parser.add_option("--processes", dest="num_processes", default=1,
+                      type="int",
+                      help="Number of processes to serve requests with")
+    parser.add_option("--cache-size", dest="cache_size", default=64,
+                      type="int",
+                      help="Megabytes of memory to use for caching "
+                      "search results, and again for file views "
+                      "(0 to disable)")
+    parser.add_option("--search-timeout", dest="search_timeout",
+                      default=60, type="float",
+                      help="Seconds after which to abandon a grep")
+    parser.add_option("--search-backend", dest="search_backend",
+                      default="grep", type="choice",
+                      choices=list(search_backends),
+                      help="How to search files without an index: by "
+                      "running grep, or in-process using mmap")
+    parser.add_option("--search-processes", dest="search_processes",
+                      default=None, type="int",
+                      help="Number of grep processes to run at once for "
+                      "a search (default: number of CPUs)")
+    parser.add_option("--chunk-size", dest="chunk_size", default=64,
+                      type="int",
+                      help="Kilobytes of output to send at a time")
+    parser.add_option("--no-gzip", dest="gzip", action="store_false",
+                      default=True,
+                      help="Don't compress responses")
     options, args = parser.parse_args(argv)
     if len(args) != 0:
         parser.error("Unexpected arguments")
+    if options.index_daemon:
+        if options.index_dir is None:
+            parser.error("--index-daemon requires --index-dir")
+        # The indexer thread would only exist in the parent process.
+        if options.num_processes > 1:
+            parser.error("--index-daemon can't be used with --processes")
     fileset = make_fileset(options.dir_path,
-                           case_sensitive=options.case_sensitive)
-    handler = functools.partial(handle_request, fileset)
+                           case_sensitive=options.case_sensitive,
+                           index_dir=options.index_dir,
+                           search_timeout=options.search_timeout,
+                           search_backend=options.search_backend,
+                           search_processes=options.search_processes)
+    if options.index_daemon:
+        fileset.start_indexer()
+    search_cache = None
+    file_cache = None
+    if options.cache_size > 0:
+        search_cache = LRUCache(max_entries=1000,
+                                max_bytes=options.cache_size << 20)
+        file_cache = LRUCache(max_entries=1000,
+                              max_bytes=options.cache_size << 20)
+    handler = buffer_response(
+        functools.partial(handle_request, fileset,
+                          search_cache=search_cache,
+                          file_cache=file_cache),
+        chunk_size=options.chunk_size << 10,
+        compress=options.gzip)
     if options.do_cgi:
         wsgiref.handlers.CGIHandler().run(handler)
     else:
-        httpd = wsgiref.simple_server.make_server("", options.port, handler)
+        if options.do_once:
+            options.num_threads = 1
+        httpd = make_server(options.port, handler, options.num_threads)
         print "Listening on port %i" % options.port
         if options.do_once:
             httpd.handle_request()
+        elif options.num_processes > 1:
+            serve_forked(httpd, options.num_processes)
         else:
             httpd.serve_forever()
 
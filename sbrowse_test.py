@@ -16,10 +16,15 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301 USA.
 
+import StringIO
 import os
 import unittest
 import subprocess
 import sys
+import threading
+import time
+import urllib2
+import zlib
 
 import sbrowse
 import tempdir_test
@@ -44,17 +49,37 @@ def write_file(filename, data):
         fh.close()
 
 
+def process_exists(pid):
+    try:
+        fh = open("/proc/%i/stat" % pid, "r")
+    except IOError:
+        return False
+    try:
+        # Zombies, which have state "Z", count as dead.
+        return fh.read().split(") ", 1)[1][0] != "Z"
+    finally:
+        fh.close()
+
+
 class TokenizerTest(unittest.TestCase):
 
     def test_tokenizer(self):
-        self.assertEquals(list(sbrowse.tokens("  foo !! bar31 + _qux && ")),
-                          [("  ", False), 
-                           ("foo", True), 
-                           (" !! ", False), 
-                           ("bar31", True),
-                           (" + ", False), 
-                           ("_qux", True), 
-                           (" && ", False)])
+        # Symbols are at the odd indexes.
+        self.assertEquals(sbrowse.split_tokens("  foo !! bar31 + _qux && "),
+                          ["  ", 
+                           "foo", 
+                           " !! ", 
+                           "bar31",
+                           " + ", 
+                           "_qux", 
+                           " && "])
+        self.assertEquals(sbrowse.split_tokens("foo"), ["", "foo", ""])
+
+    def test_split_lines_tokens(self):
+        for data in ["", "\n", "foo", "foo\n", "a b\n\n c;\nd", "\n\nx\n"]:
+            lines = StringIO.StringIO(data).readlines()
+            self.assertEquals(sbrowse.split_lines_tokens(data),
+                              [sbrowse.split_tokens(line) for line in lines])
 
 
 class FileSetTests(tempdir_test.TempDirTestCase):
@@ -84,7 +109,7 @@ class FileSetTests(tempdir_test.TempDirTestCase):
             ["bar", "foo", "mysubdir", "mysubdir/jam"])
         self.assertEquals(list(fileset.grep_files("", "blah")), [])
         self.assertEquals(list(fileset.grep_files("", "hello")),
-                          ["foo", "bar"])
+                          ["bar", "foo"])
         self.check_file_set(fileset)
 
     def test_git_file_set(self):
@@ -112,12 +137,313 @@ class FileSetTests(tempdir_test.TempDirTestCase):
                               cwd=tempdir)
         fileset = sbrowse.make_fileset(tempdir)
         self.assertEquals(list(fileset.list_files("")),
-                          ["mysubdir/jam", "mysubdir", "foo"])
+                          ["foo", "mysubdir", "mysubdir/jam"])
         # "bar" has not been git-added, so shouldn't be listed.
         self.assertEquals(list(fileset.grep_files("", "hello")), ["foo"])
         self.assertEquals(list(fileset.grep_files("", "Hello")), ["foo"])
         self.check_file_set(fileset)
 
+    def test_svn_file_set_in_process(self):
+        tempdir = self.example_tree()
+        os.mkdir(os.path.join(tempdir, ".svn"))
+        statuses = []
+
+        class FakeClient(object):
+
+            def status(self, path):
+                statuses.append(path)
+                return [{"path": os.path.join(path, rel_path),
+                         "is_versioned": rel_path != "bar",
+                         "text_status": "normal"}
+                        for rel_path in ("", "foo", "bar", "mysubdir",
+                                         "mysubdir/jam")]
+
+        class FakePysvn(object):
+
+            Client = FakeClient
+
+            class wc_status_kind(object):
+
+                ignored = "ignored"
+
+        old_pysvn = sbrowse.pysvn
+        sbrowse.pysvn = FakePysvn
+        try:
+            fileset = sbrowse.make_fileset(tempdir)
+            self.assertEquals(fileset.list_files(""),
+                              ["foo", "mysubdir", "mysubdir/jam"])
+            self.check_file_set(fileset)
+        finally:
+            sbrowse.pysvn = old_pysvn
+        # The list is kept until the SVN metadata changes.
+        self.assertEquals(len(statuses), 1)
+
+    def test_sharded_grep(self):
+        tempdir = self.example_tree()
+        for leafname in ("a", "b-", "-c", "d"):
+            write_file(os.path.join(tempdir, leafname), "hello")
+        fileset = sbrowse.make_fileset(tempdir, search_processes=3)
+        fileset.grep_shard_size = 2
+        # The results are in order even though the shards are searched
+        # at the same time.
+        self.assertEquals(list(fileset.grep_files("", "hello")),
+                          ["-c", "a", "b-", "bar", "d", "foo"])
+        self.assertEquals(list(fileset.grep_files("", "-c")), [])
+        self.check_file_set(fileset)
+
+    def test_mmap_file_set(self):
+        tempdir = self.example_tree()
+        write_file(os.path.join(tempdir, "empty"), "")
+        fileset = sbrowse.make_fileset(tempdir, search_backend="mmap")
+        self.assertEquals(list(fileset.grep_files("", "hello")),
+                          ["bar", "foo"])
+        self.check_file_set(fileset)
+        fileset = sbrowse.make_fileset(tempdir, case_sensitive=True,
+                                       search_backend="mmap")
+        self.assertEquals(list(fileset.grep_files("", "hello")), [])
+        self.assertEquals(list(fileset.grep_files("", "Hello")),
+                          ["bar", "foo"])
+
+    def test_grep_lines(self):
+        tempdir = self.make_temp_dir()
+        write_file(os.path.join(tempdir, "foo"),
+                   "one\nFoo foo\r\nthree\n\nfoo")
+        write_file(os.path.join(tempdir, "bar"), "no match\n")
+        for backend in sbrowse.search_backends:
+            fileset = sbrowse.make_fileset(tempdir, search_backend=backend)
+            self.assertEquals(list(fileset.grep_lines("", "foo")),
+                              [("foo", 1, "Foo foo"), ("foo", 4, "foo")])
+
+    def test_whole_word_grep(self):
+        tempdir = self.make_temp_dir()
+        write_file(os.path.join(tempdir, "a"), "foo_bar\nFOO\n")
+        write_file(os.path.join(tempdir, "b"), "x = foo;\n")
+        write_file(os.path.join(tempdir, "c"), "foo(1)\nfoo2\n")
+        for kwargs in ({}, {"search_backend": "mmap"},
+                       {"index_dir": self.make_temp_dir()}):
+            fileset = sbrowse.make_fileset(tempdir, **kwargs)
+            self.assertEquals(list(fileset.grep_files("", "foo")),
+                              ["a", "b", "c"])
+            self.assertEquals(
+                list(fileset.grep_files("", "foo", whole_word=True)),
+                ["b", "c"])
+            self.assertEquals(
+                list(fileset.grep_lines("", "foo", whole_word=True)),
+                [("b", 0, "x = foo;"), ("c", 0, "foo(1)")])
+            self.assertEquals(
+                list(fileset.grep_lines("", "foo", whole_word=True,
+                                        all_lines=True)),
+                [("b", 0, "x = foo;"), ("c", 0, "foo(1)"), ("c", 1, "foo2")])
+
+    def test_binary_files(self):
+        tempdir = self.example_tree()
+        write_file(os.path.join(tempdir, "bin"), "Hello\0world")
+        for kwargs in ({}, {"search_backend": "mmap"},
+                       {"index_dir": self.make_temp_dir()}):
+            fileset = sbrowse.make_fileset(tempdir, **kwargs)
+            self.assertEquals(list(fileset.grep_files("", "world")), ["foo"])
+            self.assertEquals(fileset.file_kind("bin"), "binary")
+            self.assertEquals(fileset.file_kind("foo"), "text")
+        subprocess.check_call(["git", "init", "-q"], cwd=tempdir)
+        subprocess.check_call(["git", "add", "foo", "bin"], cwd=tempdir)
+        fileset = sbrowse.make_fileset(tempdir)
+        self.assertEquals(list(fileset.grep_files("", "world")), ["foo"])
+
+    def test_indexed_file_set(self):
+        tempdir = self.example_tree()
+        index_dir = os.path.join(self.make_temp_dir(), "index")
+        fileset = sbrowse.make_fileset(tempdir, index_dir=index_dir)
+        self.assertEquals(list(fileset.grep_files("", "hello")),
+                          ["bar", "foo"])
+        self.assertEquals(list(fileset.grep_files("", "lo, th")), ["bar"])
+        self.check_file_set(fileset)
+        self.assertEquals(fileset.symbol_matches("", "Hello"),
+                          [("bar", [0]), ("foo", [0])])
+        self.assertEquals(fileset.symbol_matches("mysubdir", "raspberry"),
+                          [("jam", [0])])
+        self.assertEquals(fileset.related_symbols("", "ell"),
+                          ({"Hello": 2}, {}))
+        self.assertEquals(fileset.related_symbols("", "HELL"),
+                          ({}, {"Hello": 2}))
+        self.assertEquals(len(os.listdir(index_dir)), 1)
+        # A new FileSet should pick up the index saved on disk.
+        fileset = sbrowse.make_fileset(tempdir, index_dir=index_dir)
+        fileset._update_index = lambda index: False
+        self.assertEquals(list(fileset.grep_files("", "world")), ["foo"])
+
+    def test_indexed_file_set_update(self):
+        tempdir = self.example_tree()
+        fileset = sbrowse.make_fileset(tempdir, index_dir=self.make_temp_dir())
+        fileset.index_refresh_interval = 0
+        fileset.file_list_check_interval = 0
+        self.assertEquals(list(fileset.grep_files("", "world")), ["foo"])
+        write_file(os.path.join(tempdir, "foo"), "Goodbye worlds")
+        write_file(os.path.join(tempdir, "new"), "new world")
+        os.unlink(os.path.join(tempdir, "bar"))
+        self.assertEquals(list(fileset.grep_files("", "world")),
+                          ["foo", "new"])
+        self.assertEquals(list(fileset.grep_files("", "goodbye")), ["foo"])
+        self.assertEquals(list(fileset.grep_files("", "hello")), [])
+
+    def test_indexed_git_file_set_update(self):
+        tempdir = self.example_tree()
+        subprocess.check_call(["git", "init", "-q"], cwd=tempdir)
+        subprocess.check_call(["git", "add", "foo"], cwd=tempdir)
+        fileset = sbrowse.make_fileset(tempdir, index_dir=self.make_temp_dir())
+        fileset.index_refresh_interval = 0
+        self.assertEquals(list(fileset.grep_files("", "hello")), ["foo"])
+        write_file(os.path.join(tempdir, "foo"), "Goodbye")
+        subprocess.check_call(["git", "add", "foo", "bar"], cwd=tempdir)
+        self.assertEquals(list(fileset.grep_files("", "hello")), ["bar"])
+        self.assertEquals(list(fileset.grep_files("", "goodbye")), ["foo"])
+        # Unstaged changes are indexed too, as git grep searches them.
+        write_file(os.path.join(tempdir, "bar"), "Goodbye again")
+        self.assertEquals(list(fileset.grep_files("", "goodbye")),
+                          ["bar", "foo"])
+        self.assertEquals(fileset.symbol_matches("", "again"), [("bar", [0])])
+
+    def test_index_saved_incrementally(self):
+        tempdir = self.example_tree()
+        index_dir = self.make_temp_dir()
+        fileset = sbrowse.make_fileset(tempdir, index_dir=index_dir)
+        fileset.index_refresh_interval = 0
+        fileset.file_list_check_interval = 0
+        self.assertEquals(list(fileset.grep_files("", "world")), ["foo"])
+        index_file = fileset._index_file()
+        snapshot = read_file(index_file)
+        write_file(os.path.join(tempdir, "new"), "new world")
+        os.unlink(os.path.join(tempdir, "bar"))
+        self.assertEquals(list(fileset.grep_files("", "world")),
+                          ["foo", "new"])
+        # The change is appended to a log rather than rewriting the index.
+        self.assertEquals(read_file(index_file), snapshot)
+        self.assertTrue(os.path.exists(index_file + ".log"))
+        index = sbrowse.SearchIndex.load(index_file)
+        self.assertEquals(sorted(index.stamps()),
+                          ["foo", "mysubdir/jam", "new"])
+        self.assertEquals(index.candidates("world"), ["foo", "new"])
+
+    def wait_for(self, func):
+        for i in range(200):
+            if func():
+                return
+            time.sleep(0.05)
+        self.fail("Timed out")
+
+    def test_background_indexer(self):
+        tempdir = self.example_tree()
+        fileset = sbrowse.make_fileset(tempdir, index_dir=self.make_temp_dir())
+        fileset.index_refresh_interval = 0.05
+        fileset.file_list_check_interval = 0
+        fileset.start_indexer()
+        try:
+            self.wait_for(
+                lambda: fileset.symbol_matches("", "Hello") is not None)
+            self.assertEquals(fileset.symbol_matches("", "Hello"),
+                              [("bar", [0]), ("foo", [0])])
+            write_file(os.path.join(tempdir, "new"), "Hello")
+            self.wait_for(
+                lambda: len(fileset.symbol_matches("", "Hello")) == 3)
+            # Searches don't wait while the indexer is busy, but use grep.
+            fileset._index_lock.acquire()
+            try:
+                self.assertEquals(fileset.symbol_matches("", "Hello"), None)
+                self.assertEquals(list(fileset.grep_files("", "world")),
+                                  ["foo"])
+            finally:
+                fileset._index_lock.release()
+        finally:
+            fileset.stop_indexer()
+
+    def test_index_priority(self):
+        fileset = sbrowse.make_fileset(self.make_temp_dir())
+        viewed = {"a": 1, "a/b": 3, "c": 2}
+        files = ["a/x", "a/b/y", "c/d/z", "e"]
+        files.sort(key=lambda filename:
+                       fileset._index_priority(filename, viewed))
+        self.assertEquals(files, ["a/b/y", "c/d/z", "a/x", "e"])
+
+    def test_fs_file_list_update(self):
+        tempdir = self.example_tree()
+        fileset = sbrowse.make_fileset(tempdir)
+        fileset.file_list_check_interval = 0
+        self.assertEquals(fileset.list_files("mysubdir"), ["jam"])
+        write_file(os.path.join(tempdir, "mysubdir", "jam2"), "")
+        os.mkdir(os.path.join(tempdir, "mysubdir", "nested"))
+        write_file(os.path.join(tempdir, "mysubdir", "nested", "x"), "")
+        self.assertEquals(fileset.list_files("mysubdir"),
+                          ["jam", "jam2", "nested", "nested/x"])
+        os.unlink(os.path.join(tempdir, "mysubdir", "nested", "x"))
+        self.assertEquals(fileset.list_files("mysubdir"),
+                          ["jam", "jam2", "nested"])
+        self.assertEquals(fileset.list_files("mysub"), [])
+
+    def test_git_file_list_update(self):
+        tempdir = self.example_tree()
+        subprocess.check_call(["git", "init", "-q"], cwd=tempdir)
+        subprocess.check_call(["git", "add", "foo"], cwd=tempdir)
+        fileset = sbrowse.make_fileset(tempdir)
+        fileset.file_list_check_interval = 0
+        self.assertEquals(fileset.list_files(""), ["foo"])
+        subprocess.check_call(["git", "add", "bar", "mysubdir"], cwd=tempdir)
+        self.assertEquals(fileset.list_files(""),
+                          ["bar", "foo", "mysubdir/jam"])
+        self.assertEquals(fileset.list_files("mysubdir"), ["jam"])
+
+    def test_list_dir_entries(self):
+        tempdir = self.example_tree()
+        fileset = sbrowse.make_fileset(tempdir)
+        self.assertEquals(fileset.list_dir_entries(""),
+                          [("bar", False, 25), ("foo", False, 11),
+                           ("mysubdir", True, None)])
+        os.symlink("does-not-exist", os.path.join(tempdir, "mysubdir", "link"))
+        self.assertEquals(fileset.list_dir_entries("mysubdir"),
+                          [("jam", False, 9), ("link", False, None)])
+        # The cached listing is not used once the directory changes.
+        os.unlink(os.path.join(tempdir, "mysubdir", "link"))
+        self.assertEquals(fileset.list_dir_entries("mysubdir"),
+                          [("jam", False, 9)])
+
+    def test_file_links(self):
+        tempdir = self.example_tree()
+        write_file(os.path.join(tempdir, "crossrefs.sbrowse"),
+                   "top:http://top/%s\n")
+        write_file(os.path.join(tempdir, "mysubdir", "crossrefs.sbrowse"),
+                   "sub:http://sub/%s\n")
+        fileset = sbrowse.make_fileset(tempdir)
+        self.assertEquals(fileset.get_file_links("foo"),
+                          [("top", "http://top/foo\n")])
+        self.assertEquals(fileset.get_file_links("mysubdir/jam"),
+                          [("top", "http://top/mysubdir/jam\n"),
+                           ("sub", "http://sub/jam\n")])
+        write_file(os.path.join(tempdir, "crossrefs.sbrowse"),
+                   "new:http://new/%s\n")
+        os.utime(os.path.join(tempdir, "crossrefs.sbrowse"), (0, 0))
+        self.assertEquals(fileset.get_file_links("foo"),
+                          [("new", "http://new/foo\n")])
+        os.unlink(os.path.join(tempdir, "mysubdir", "crossrefs.sbrowse"))
+        self.assertEquals(fileset.get_file_links("mysubdir/jam"),
+                          [("new", "http://new/mysubdir/jam\n")])
+        # Adding the file changes the directory's mtime.
+        write_file(os.path.join(tempdir, "mysubdir", "crossrefs.sbrowse"),
+                   "sub:http://sub/%s\n")
+        os.utime(os.path.join(tempdir, "mysubdir"), (0, 0))
+        self.assertEquals(fileset.get_file_links("mysubdir/jam"),
+                          [("new", "http://new/mysubdir/jam\n"),
+                           ("sub", "http://sub/jam\n")])
+
+    def test_file_links_untracked(self):
+        # crossrefs files are usually local configuration, which is not
+        # checked in.
+        tempdir = self.example_tree()
+        subprocess.check_call(["git", "init", "-q"], cwd=tempdir)
+        subprocess.check_call(["git", "add", "foo"], cwd=tempdir)
+        write_file(os.path.join(tempdir, "crossrefs.sbrowse"),
+                   "top:http://top/%s\n")
+        fileset = sbrowse.make_fileset(tempdir)
+        self.assertEquals(fileset.get_file_links("foo"),
+                          [("top", "http://top/foo\n")])
+
     def test_combined_file_set(self):
         tempdir1 = self.make_temp_dir()
         write_file(os.path.join(tempdir1, "foo"), "qux")
@@ -134,12 +460,148 @@ class FileSetTests(tempdir_test.TempDirTestCase):
         self.assertEquals(fileset.list_dir(""), ["aa", "bb"])
         self.assertEquals(fileset.list_dir("aa"), ["foo", "subdir"])
         self.assertEquals(list(fileset.list_files("aa")), ["foo", "subdir"])
+        self.assertEquals(fileset.list_dir_entries(""),
+                          [("aa", True, None), ("bb", True, None)])
+        self.assertEquals(fileset.list_dir_entries("aa"),
+                          [("foo", False, 3), ("subdir", True, None)])
         self.assertEquals(list(fileset.grep_files("aa", "qu")), ["foo"])
         self.assertEquals(list(fileset.list_files("")),
                           ["aa", "aa/foo", "aa/subdir",
                            "bb", "bb/bar"])
         self.assertEquals(list(fileset.grep_files("", "qux")), ["aa/foo"])
         self.assertEquals(list(fileset.grep_files("", "quux")), ["bb/bar"])
+        self.assertEquals(fileset.get_path_index().find("bbar", 10),
+                          [("bb/bar", [1, 3, 4, 5])])
+
+
+class PopenTest(unittest.TestCase):
+
+    def test_process_stopped_on_close(self):
+        lines = sbrowse.popen_filenames(["sh", "-c", "echo $$; exec sleep 60"])
+        pid = int(lines.next())
+        lines.close()
+        # The process should have been killed and reaped.
+        self.assertRaises(OSError, lambda: os.kill(pid, 0))
+
+    def test_process_group_stopped_on_close(self):
+        lines = sbrowse.popen_filenames(
+            ["sh", "-c", "sleep 60 & echo $!; wait"])
+        pid = int(lines.next())
+        self.assertTrue(process_exists(pid))
+        lines.close()
+        # The shell's child should have been killed too.
+        for i in range(100):
+            if not process_exists(pid):
+                break
+            time.sleep(0.01)
+        self.assertFalse(process_exists(pid))
+
+    def test_timeout(self):
+        lines = sbrowse.popen_filenames(["sh", "-c", "echo a; sleep 60"],
+                                        timeout=0.2)
+        self.assertEquals(lines.next(), "a")
+        self.assertRaises(sbrowse.SearchTimeout, lambda: list(lines))
+
+
+class PathIndexTest(unittest.TestCase):
+
+    def test_find(self):
+        index = sbrowse.PathIndex(["docs/readme", "foo/bar.c",
+                                   "lib/fancy_obj_oracle.c", "src/foo.c"])
+        self.assertEquals([path for path, positions in index.find("foo", 10)],
+                          ["src/foo.c", "lib/fancy_obj_oracle.c",
+                           "foo/bar.c"])
+        self.assertEquals(index.find("FOO", 1), [("src/foo.c", [4, 5, 6])])
+        self.assertEquals(index.find("xyz", 10), [])
+        self.assertEquals(index.find("", 10), [])
+        self.assertEquals(index.find("o/b", 10), [("foo/bar.c", [2, 3, 4])])
+
+    def test_find_does_not_backtrack(self):
+        index = sbrowse.PathIndex(["a" * 2000])
+        start = time.time()
+        self.assertEquals(index.find("a" * 20 + "z", 10), [])
+        self.assertTrue(time.time() - start < 1)
+
+    def test_find_scores_only_some_matches(self):
+        paths = ["dir%i/file.c" % i for i in range(20)] + ["file.c"]
+        index = sbrowse.PathIndex(paths)
+        index.max_scored = 5
+        # The shortest matches are scored first.
+        self.assertEquals(index.find("file", 1), [("file.c", [0, 1, 2, 3])])
+        self.assertEquals(len(index.find("file", 100)), 5)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = sbrowse.LRUCache(max_entries=2, max_bytes=10)
+        cache.put("a", "aaa")
+        cache.put("b", "bbb")
+        self.assertEquals(cache.get("a"), "aaa")
+        # "b" is now the least recently used entry.
+        cache.put("c", "ccc")
+        self.assertEquals(cache.get("b"), None)
+        self.assertEquals(cache.get("a"), "aaa")
+        # Exceeding the size limit evicts entries too.
+        cache.put("d", "dddddd")
+        self.assertEquals(cache.get("c"), None)
+        self.assertEquals(cache.get("a"), "aaa")
+        self.assertEquals(cache.get("d"), "dddddd")
+        # Entries bigger than the limit aren't cached at all.
+        cache.put("e", "e" * 11)
+        self.assertEquals(cache.get("e"), None)
+        self.assertEquals(cache.get("d"), "dddddd")
+
+
+class ParallelChainTest(tempdir_test.TempDirTestCase):
+
+    def test_parallel_chain(self):
+        last_started = threading.Event()
+        def first():
+            # This would deadlock if the functions ran one at a time.
+            last_started.wait(10)
+            yield last_started.isSet()
+        def second():
+            return ["a", "b"]
+        def last():
+            last_started.set()
+            return ["c"]
+        self.assertEquals(list(sbrowse.parallel_chain([first, second, last],
+                                                      num_threads=3)),
+                          [True, "a", "b", "c"])
+
+    def test_parallel_chain_error(self):
+        def fail():
+            raise ValueError()
+        funcs = [lambda: [1], fail, lambda: [2]]
+        self.assertRaises(ValueError,
+                          lambda: list(sbrowse.parallel_chain(funcs, 1)))
+
+    def test_parallel_chain_stops_processes_on_close(self):
+        pid_file = os.path.join(self.make_temp_dir(), "pids")
+        def sleeper():
+            return sbrowse.popen_filenames(
+                ["sh", "-c", "echo $$ >> %s; echo $$; exec sleep 60"
+                 % pid_file])
+        # The first function's grep runs on a nested parallel_chain, as
+        # CombinedFileSet's members' searches do.
+        funcs = [lambda: sbrowse.parallel_chain([sleeper], 1), sleeper]
+        chain = sbrowse.parallel_chain(funcs, 2)
+        chain.next()
+        for i in range(100):
+            pids = [int(line) for line in read_file(pid_file).split()]
+            if len(pids) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEquals(len(pids), 2)
+        start = time.time()
+        chain.close()
+        # Both processes are killed, even though the workers are blocked
+        # reading from them.
+        for pid in pids:
+            while process_exists(pid) and time.time() - start < 5:
+                time.sleep(0.01)
+            self.assertFalse(process_exists(pid))
 
 
 class GoldenTest(object):
@@ -167,26 +629,24 @@ class GoldenTest(object):
 
 class RequestTests(GoldenTest, tempdir_test.TempDirTestCase):
 
-    def get_response(self, fileset, uri, query=""):
-        # TODO: Don't require monkey-patching
-        sbrowse.stylesheet = \
-            lambda: ['<link rel="stylesheet" href="../styles.css"/>']
+    def get_response(self, fileset, uri, query="", **kwargs):
         def start_response(response_code, headers):
             self.assertEquals(response_code, "200 OK")
         environ = {"SCRIPT_NAME": "script_name",
                    "PATH_INFO": uri,
                    "QUERY_STRING": query,
                    "HTTP_HOST": "localhost:8000"}
-        iterable = sbrowse.handle_request(fileset, environ, start_response)
+        iterable = sbrowse.handle_request(fileset, environ, start_response,
+                                          **kwargs)
         return "\n".join(iterable)
 
-    def example_input(self):
+    def example_input(self, **kwargs):
         tempdir = self.make_temp_dir()
         write_file(os.path.join(tempdir, "foofile"),
                    "foo data!\nmore data\nanother foo match\n")
         os.mkdir(os.path.join(tempdir, "foodir"))
         write_file(os.path.join(tempdir, "foodir/nested-file"), "nested")
-        return sbrowse.FSFileSet(tempdir)
+        return sbrowse.FSFileSet(tempdir, **kwargs)
 
     def test_symbol_search(self):
         fileset = self.example_input()
@@ -198,6 +658,198 @@ class RequestTests(GoldenTest, tempdir_test.TempDirTestCase):
         page = self.get_response(fileset, "/search", "sym=oo")
         self.assert_golden(page, "search-substring.html")
 
+    def test_symbol_search_mmap(self):
+        fileset = self.example_input(search_backend="mmap")
+        page = self.get_response(fileset, "/search", "sym=foo")
+        self.assert_golden(page, "search.html")
+        page = self.get_response(fileset, "/search", "sym=nested&dir=foodir")
+        self.assert_golden(page, "search-subdir.html")
+
+    def test_symbol_search_indexed(self):
+        fileset = self.example_input(index_dir=self.make_temp_dir())
+        page = self.get_response(fileset, "/search", "sym=foo")
+        self.assert_golden(page, "search.html")
+        page = self.get_response(fileset, "/search", "sym=oo")
+        self.assert_golden(page, "search-substring.html")
+        page = self.get_response(fileset, "/search", "sym=nested&dir=foodir")
+        self.assert_golden(page, "search-subdir.html")
+
+    def test_symbol_search_index_locked_between_queries(self):
+        fileset = self.example_input(index_dir=self.make_temp_dir())
+        fileset.start_indexer()
+        try:
+            while not fileset._index_ready:
+                time.sleep(0.01)
+            symbol_matches = fileset.symbol_matches
+            def symbol_matches_then_lock(subdir, sym):
+                result = symbol_matches(subdir, sym)
+                # The indexer takes the lock before the symbols found
+                # are looked up.
+                fileset._index_lock.acquire()
+                return result
+            fileset.symbol_matches = symbol_matches_then_lock
+            try:
+                page = self.get_response(fileset, "/search", "sym=foo")
+            finally:
+                fileset._index_lock.release()
+            self.assert_golden(page, "search.html")
+        finally:
+            fileset.stop_indexer()
+
+    def test_symbol_search_cached(self):
+        fileset = self.example_input()
+        fileset.file_list_check_interval = 0
+        cache = sbrowse.LRUCache(max_entries=10, max_bytes=100000)
+        page = self.get_response(fileset, "/search", "sym=foo",
+                                 search_cache=cache)
+        self.assert_golden(page, "search.html")
+        self.assertEquals(len(cache._entries), 1)
+        page2 = self.get_response(fileset, "/search", "sym=foo",
+                                  search_cache=cache)
+        self.assertEquals(page2.replace("\n", ""), page.replace("\n", ""))
+        self.assertEquals(len(cache._entries), 1)
+        # Adding a file invalidates the cached result.
+        write_file(os.path.join(fileset._dir_path, "foodir/bar"), "foo")
+        page = self.get_response(fileset, "/search", "sym=foo",
+                                 search_cache=cache)
+        self.assertTrue("foodir/bar" in page)
+        self.assertEquals(len(cache._entries), 2)
+
+    def test_symbol_search_cache_follows_file_list(self):
+        # The file list is only reread every file_list_check_interval
+        # seconds, so a search made just after a file is added can miss
+        # it.  That page must not be cached beyond the next reread.
+        fileset = self.example_input()
+        cache = sbrowse.LRUCache(max_entries=10, max_bytes=100000)
+        page = self.get_response(fileset, "/search", "sym=foo",
+                                 search_cache=cache)
+        write_file(os.path.join(fileset._dir_path, "bar"), "foo")
+        page = self.get_response(fileset, "/search", "sym=foo",
+                                 search_cache=cache)
+        time.sleep(fileset.file_list_check_interval + 0.1)
+        page = self.get_response(fileset, "/search", "sym=foo",
+                                 search_cache=cache)
+        self.assertTrue("script_name/file/bar" in page)
+
+    def test_find(self):
+        fileset = self.example_input()
+        page = self.get_response(fileset, "/find", "q=nfile")
+        self.assertTrue("<a href='script_name/file/foodir/nested-file'>"
+                        "foodir/<strong>n</strong>ested-<strong>file</strong>"
+                        "</a>" in page)
+        self.assertTrue("foofile" not in page)
+        page = self.get_response(fileset, "/find", "q=%27%3E%3Cb%3E")
+        self.assertTrue("value='&#39;&gt;&lt;b&gt;'" in page)
+        self.assertTrue("<b>" not in page)
+
+    def test_symbol_search_pages(self):
+        fileset = self.example_input()
+        page = self.get_response(fileset, "/search", "sym=foo&limit=1")
+        self.assertTrue("#line1'>1</a>" in page)
+        self.assertTrue("#line3'>3</a>" not in page)
+        self.assertTrue("<a href='script_name/search?dir=&sym=foo"
+                        "&offset=1&limit=1'>more results</a>" in page)
+        page = self.get_response(fileset, "/search",
+                                 "sym=foo&offset=1&limit=1")
+        self.assertTrue("#line1'>1</a>" not in page)
+        self.assertTrue("#line3'>3</a>" in page)
+        self.assertTrue("more results" not in page)
+
+    def test_symbol_search_related_symbols(self):
+        fileset = self.example_input()
+        write_file(os.path.join(fileset._dir_path, "other"),
+                   "foo\nfoo_bar\nFOO2\n")
+        opened = []
+        open_file = fileset.open_file
+        def counting_open_file(filename):
+            opened.append(filename)
+            return open_file(filename)
+        fileset.open_file = counting_open_file
+        # Each file is read once, whether the symbols are counted while
+        # finding the matches or afterwards, except that a file that the
+        # page fills partway through is read again to count the rest.
+        for query, expect_opened in [
+                ("sym=foo", ["foofile", "other"]),
+                ("sym=foo&limit=1", ["foofile", "foofile", "other"])]:
+            del opened[:]
+            page = self.get_response(fileset, "/search", query)
+            self.assertTrue("sym=foo_bar'>foo_bar</a> (1)" in page)
+            self.assertTrue("sym=FOO2'>FOO2</a> (1)" in page)
+            self.assertEquals(sorted(opened), expect_opened)
+        # Later pages don't work out the list again.
+        del opened[:]
+        page = self.get_response(fileset, "/search",
+                                 "sym=foo&offset=1&limit=1")
+        self.assertTrue("Other symbols found" not in page)
+        self.assertEquals(opened, ["foofile", "other"])
+
+    def test_symbol_search_related_symbols_after_full_page(self):
+        fileset = self.example_input()
+        write_file(os.path.join(fileset._dir_path, "a.c"),
+                   "foo\nfoo\nfoo_bar\n")
+        page = self.get_response(fileset, "/search", "sym=foo&limit=1")
+        self.assertTrue("sym=foo_bar'>foo_bar</a> (1)" in page)
+        self.assertTrue("the list is incomplete" not in page)
+        old_limit = sbrowse.related_symbols_lines_limit
+        sbrowse.related_symbols_lines_limit = 1
+        try:
+            page = self.get_response(fileset, "/search", "sym=foo&limit=1")
+            self.assertTrue("the list is incomplete" in page)
+        finally:
+            sbrowse.related_symbols_lines_limit = old_limit
+
+    def test_symbol_search_page_limits(self):
+        fileset = self.example_input()
+        old_limit = sbrowse.search_results_limit
+        sbrowse.search_results_limit = 1
+        try:
+            # The limit can't be raised above the default, or disabled.
+            for limit in ("5", "-1", "0"):
+                page = self.get_response(fileset, "/search",
+                                         "sym=foo&limit=%s" % limit)
+                self.assertTrue("#line3'>3</a>" not in page)
+                self.assertTrue("&offset=1&limit=1'>more results" in page)
+            page = self.get_response(fileset, "/search", "sym=foo&offset=-5")
+            self.assertTrue("#line1'>1</a>" in page)
+        finally:
+            sbrowse.search_results_limit = old_limit
+        responses = []
+        def start_response(response_code, headers):
+            responses.append(response_code)
+        environ = {"SCRIPT_NAME": "script_name",
+                   "PATH_INFO": "/search",
+                   "QUERY_STRING": "sym=foo&limit=x",
+                   "HTTP_HOST": "localhost:8000"}
+        sbrowse.handle_request(fileset, environ, start_response)
+        self.assertEquals(responses, ["400 Bad request"])
+
+    def test_symbol_search_timeout(self):
+        fileset = self.example_input()
+        fileset._grep_files = lambda *args: sbrowse.popen_filenames(
+            ["sh", "-c", "echo foofile; sleep 60"], timeout=0.2)
+        cache = sbrowse.LRUCache(max_entries=10, max_bytes=100000)
+        page = self.get_response(fileset, "/search", "sym=foo",
+                                 search_cache=cache)
+        self.assertTrue("#line3'>3</a>" in page)
+        self.assertTrue("Search timed out" in page)
+        # Incomplete results are not cached.
+        self.assertEquals(len(cache._entries), 0)
+
+    def test_git_search_cache_sees_unstaged_changes(self):
+        fileset = self.example_input()
+        tempdir = fileset._dir_path
+        subprocess.check_call(["git", "init", "-q"], cwd=tempdir)
+        subprocess.check_call(["git", "add", "foofile"], cwd=tempdir)
+        fileset = sbrowse.make_fileset(tempdir)
+        cache = sbrowse.LRUCache(max_entries=10, max_bytes=100000)
+        page = self.get_response(fileset, "/search", "sym=goodbye",
+                                 search_cache=cache)
+        self.assertTrue("foofile" not in page)
+        write_file(os.path.join(tempdir, "foofile"), "goodbye\n")
+        page = self.get_response(fileset, "/search", "sym=goodbye",
+                                 search_cache=cache)
+        self.assertTrue("foofile" in page)
+
     def test_symbol_search_subdir(self):
         fileset = self.example_input()
         page = self.get_response(fileset, "/search", "sym=nested&dir=foodir")
@@ -213,6 +865,161 @@ class RequestTests(GoldenTest, tempdir_test.TempDirTestCase):
         page = self.get_response(fileset, "/file/foofile", "sym=foo")
         self.assert_golden(page, "file-display-highlight.html")
 
+    def test_file_display_binary(self):
+        fileset = self.example_input()
+        write_file(os.path.join(fileset._dir_path, "bin"), "foo\0bar")
+        page = self.get_response(fileset, "/file/bin")
+        self.assertTrue("Binary file (7 bytes): not shown" in page)
+        self.assertFalse("bar" in page)
+
+    def test_file_display_huge(self):
+        fileset = self.example_input()
+        old_sizes = (sbrowse.windowed_file_size, sbrowse.huge_file_size)
+        sbrowse.windowed_file_size = 10
+        sbrowse.huge_file_size = 10
+        try:
+            page = self.get_response(fileset, "/file/foofile", "sym=foo")
+            # The lines are not tokenized, so the symbols are not links.
+            self.assertTrue("<a name='line2'></a>\nmore data\n" in page)
+            self.assertTrue("<span class=highlight>\n<a name='line3'></a>"
+                            "\nanother foo match\n" in page)
+            self.assertFalse("search?" in page.split("<pre")[-1])
+        finally:
+            sbrowse.windowed_file_size, sbrowse.huge_file_size = old_sizes
+
+    def test_line_offsets(self):
+        for data, offsets in [("a\nbc\n", [0, 2, 5]),
+                              ("a\nb", [0, 2, 3]),
+                              ("", [0])]:
+            self.assertEquals(
+                list(sbrowse.line_offsets(StringIO.StringIO(data))), offsets)
+
+    def test_file_display_window(self):
+        fileset = self.example_input()
+        write_file(os.path.join(fileset._dir_path, "big"),
+                   "".join("line %i%s\n" % (i, " foo" * (i % 4 == 0))
+                           for i in range(1, 11)))
+        page = self.get_response(fileset, "/file/big", "start=4&count=3")
+        self.assertTrue("Lines 4-6 of 10" in page)
+        self.assertTrue("<a name='line4'>" in page)
+        self.assertTrue("<a name='line6'>" in page)
+        self.assertFalse("<a name='line3'>" in page)
+        self.assertFalse("<a name='line7'>" in page)
+        self.assertTrue("script_name/file/big?start=1&count=3'>previous"
+                        in page)
+        self.assertTrue("script_name/file/big?start=7&count=3'>next" in page)
+        # Jump links to matches outside the window go to the window that
+        # contains them.
+        page = self.get_response(fileset, "/file/big",
+                                 "start=4&count=3&sym=foo")
+        self.assertTrue("<a href='#line4'>3</a>" in page)
+        self.assertTrue("<a href='script_name/file/big?start=7&count=3"
+                        "&sym=foo#line8'>7</a>" in page)
+        self.assertTrue("<span class=highlight>\n<a name='line4'></a>"
+                        in page)
+        # Small files are shown whole unless a window is asked for.
+        page = self.get_response(fileset, "/file/big")
+        self.assertTrue("<a name='line10'>" in page)
+        self.assertFalse("Lines " in page)
+
+    def test_file_display_window_limits(self):
+        fileset = self.example_input()
+        old_lines = sbrowse.file_window_lines
+        sbrowse.file_window_lines = 2
+        try:
+            # The window can't be made bigger than file_window_lines.
+            page = self.get_response(fileset, "/file/foofile", "count=1000")
+            self.assertTrue("Lines 1-2 of 3" in page)
+        finally:
+            sbrowse.file_window_lines = old_lines
+        for query in ("start=abc", "count=x"):
+            responses = []
+            def start_response(response_code, headers):
+                responses.append(response_code)
+            environ = {"SCRIPT_NAME": "script_name",
+                       "PATH_INFO": "/file/foofile",
+                       "QUERY_STRING": query,
+                       "HTTP_HOST": "localhost:8000"}
+            sbrowse.handle_request(fileset, environ, start_response)
+            self.assertEquals(responses, ["400 Bad request"])
+
+    def test_symbol_search_links_to_window(self):
+        fileset = self.example_input()
+        old_size = sbrowse.windowed_file_size
+        sbrowse.windowed_file_size = 10
+        try:
+            page = self.get_response(fileset, "/search", "sym=foo")
+            self.assertTrue("script_name/file/foofile?sym=foo&start=1#line3"
+                            in page)
+            page = self.get_response(fileset, "/file/foofile")
+            self.assertTrue("Lines 1-3 of 3" in page)
+        finally:
+            sbrowse.windowed_file_size = old_size
+
+    def test_file_display_cached(self):
+        fileset = self.example_input()
+        fileset.file_list_check_interval = 0
+        cache = sbrowse.LRUCache(max_entries=10, max_bytes=100000)
+        page = self.get_response(fileset, "/file/foofile", "sym=foo",
+                                 file_cache=cache)
+        self.assert_golden(page, "file-display-highlight.html")
+        self.assertEquals(len(cache._entries), 1)
+        page = self.get_response(fileset, "/file/foofile", "sym=foo",
+                                 file_cache=cache)
+        self.assertEquals(len(cache._entries), 1)
+        page = self.get_response(fileset, "/file/foofile", file_cache=cache)
+        self.assert_golden(page, "file-display.html")
+        self.assertEquals(len(cache._entries), 2)
+
+    def test_file_not_modified(self):
+        fileset = self.example_input()
+        responses = []
+        def start_response(response_code, headers):
+            responses.append((response_code, dict(headers)))
+        environ = {"SCRIPT_NAME": "script_name",
+                   "PATH_INFO": "/file/foofile",
+                   "QUERY_STRING": "",
+                   "HTTP_HOST": "localhost:8000"}
+        sbrowse.handle_request(fileset, environ, start_response)
+        response_code, headers = responses[-1]
+        self.assertEquals(response_code, "200 OK")
+        environ["HTTP_IF_NONE_MATCH"] = headers["ETag"]
+        self.assertEquals(
+            list(sbrowse.handle_request(fileset, environ, start_response)),
+            [])
+        self.assertEquals(responses[-1][0], "304 Not Modified")
+        del environ["HTTP_IF_NONE_MATCH"]
+        environ["HTTP_IF_MODIFIED_SINCE"] = headers["Last-Modified"]
+        sbrowse.handle_request(fileset, environ, start_response)
+        self.assertEquals(responses[-1][0], "304 Not Modified")
+        # A different query gets a different ETag.
+        environ["QUERY_STRING"] = "sym=foo"
+        environ["HTTP_IF_NONE_MATCH"] = headers["ETag"]
+        sbrowse.handle_request(fileset, environ, start_response)
+        self.assertEquals(responses[-1][0], "200 OK")
+
+    def test_stylesheet(self):
+        fileset = self.example_input()
+        responses = []
+        def start_response(response_code, headers):
+            responses.append((response_code, dict(headers)))
+        environ = {"SCRIPT_NAME": "script_name",
+                   "PATH_INFO": "/static/styles.css",
+                   "QUERY_STRING": "",
+                   "HTTP_HOST": "localhost:8000"}
+        data = "".join(sbrowse.handle_request(fileset, environ,
+                                              start_response))
+        self.assertEquals(data, read_file(sbrowse.css_file))
+        response_code, headers = responses[-1]
+        self.assertEquals(response_code, "200 OK")
+        self.assertEquals(headers["Content-Type"], "text/css")
+        self.assertTrue("max-age" in headers["Cache-Control"])
+        environ["HTTP_IF_NONE_MATCH"] = "W/" + headers["ETag"]
+        self.assertEquals(
+            list(sbrowse.handle_request(fileset, environ, start_response)),
+            [])
+        self.assertEquals(responses[-1][0], "304 Not Modified")
+
     def test_file_display_nested(self):
         fileset = self.example_input()
         # TODO: Check the output
@@ -223,9 +1030,18 @@ class RequestTests(GoldenTest, tempdir_test.TempDirTestCase):
         page = self.get_response(fileset, "/file/")
         self.assert_golden(page, "dir-listing.html")
 
+    def test_directory_listing_streamed(self):
+        tempdir = self.make_temp_dir()
+        for i in range(500):
+            write_file(os.path.join(tempdir, "file%03i" % i), "")
+        fileset = sbrowse.FSFileSet(tempdir)
+        chunks = list(sbrowse.show_dir(fileset, "script_name", "", ""))
+        self.assertTrue(len(chunks) > 3)
+        page = "".join(chunks)
+        self.assertTrue(page.endswith("<a href='file499'>file499</a>"
+                                      "</td></tr></table>"))
+
     def check_for_redirect(self, fileset, uri, dest, query=""):
-        # TODO: Don't require monkey-patching
-        sbrowse.stylesheet = lambda: ()
         def start_response(response_code, headers):
             self.assertEquals(response_code, "302 OK")
             self.assertEquals(headers, [("Location", "script_name" + dest)])
@@ -262,6 +1078,102 @@ class RequestTests(GoldenTest, tempdir_test.TempDirTestCase):
             lambda: self.get_response(fileset, "/search", "sym=root&dir=/etc"))
 
 
+class BufferResponseTest(unittest.TestCase):
+
+    def make_app(self, closed):
+        def output():
+            try:
+                for i in range(1000):
+                    yield "line %i\n" % i
+            finally:
+                closed.append(True)
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/html"),
+                                      ("ETag", '"tag"')])
+            return output()
+        return app
+
+    def get_response(self, app, environ):
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+        chunks = list(app(environ, start_response))
+        return responses[0][1], chunks
+
+    def test_coalescing(self):
+        closed = []
+        app = sbrowse.buffer_response(self.make_app(closed), chunk_size=1000)
+        headers, chunks = self.get_response(app, {})
+        self.assertEquals(len(chunks), 9)
+        self.assertEquals("".join(chunks),
+                          "".join("line %i\n" % i for i in range(1000)))
+        self.assertEquals(headers["ETag"], '"tag"')
+        self.assertTrue("Content-Encoding" not in headers)
+        self.assertEquals(closed, [True])
+
+    def test_gzip(self):
+        closed = []
+        app = sbrowse.buffer_response(self.make_app(closed))
+        headers, chunks = self.get_response(
+            app, {"HTTP_ACCEPT_ENCODING": "gzip, deflate"})
+        self.assertEquals(headers["Content-Encoding"], "gzip")
+        self.assertEquals(headers["ETag"], 'W/"tag"')
+        self.assertEquals(zlib.decompress("".join(chunks),
+                                          16 + zlib.MAX_WBITS),
+                          "".join("line %i\n" % i for i in range(1000)))
+        self.assertEquals(closed, [True])
+
+    def test_gzip_streamed(self):
+        def output():
+            yield "header "
+            yield sbrowse.Flush("more ")
+            # This chunk is sent because of the pause before it.
+            time.sleep(0.1)
+            yield "late "
+            yield "end"
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/html")])
+            return output()
+        app = sbrowse.buffer_response(app, flush_interval=0.05)
+        headers, chunks = self.get_response(
+            app, {"HTTP_ACCEPT_ENCODING": "gzip"})
+        # Each chunk can be decompressed as soon as it arrives.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEquals([decompressor.decompress(chunk) for chunk in chunks],
+                          ["header more ", "late ", "end"])
+
+
+class ServerTests(unittest.TestCase):
+
+    def test_thread_pool_server(self):
+        # The first request can only see the second one if they are
+        # handled concurrently.
+        second_started = threading.Event()
+        def app(environ, start_response):
+            if environ["PATH_INFO"] == "/first":
+                second_started.wait(10)
+            else:
+                second_started.set()
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [str(second_started.isSet())]
+        httpd = sbrowse.make_server(0, app, num_threads=2)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            url = "http://localhost:%i" % httpd.server_port
+            results = []
+            first = threading.Thread(
+                target=lambda: results.append(
+                    urllib2.urlopen(url + "/first").read()))
+            first.start()
+            self.assertEquals(urllib2.urlopen(url + "/second").read(), "True")
+            first.join()
+            self.assertEquals(results, ["True"])
+        finally:
+            httpd.shutdown()
+
+
 if __name__ == "__main__":
     if "--update" in sys.argv:
         GoldenTest.update_golden = True